@@ -25,24 +25,41 @@ import os.path
 import argparse
 import re
 import requests
+import urllib.error
+import urllib.parse
 import subprocess
 import pysolr
 import xmltodict
 import dateutil.parser
+import datetime
 import warnings
 import json
 import yaml
 import math
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque
 import cartopy.crs as ccrs
 import cartopy
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from owslib.wms import WebMapService
+from owslib.map.common import WMSCapabilitiesReader
 import base64
+import numpy
+import PIL.Image
+import io
 import netCDF4
 import logging
+import multiprocessing
+import threading
+import concurrent.futures
+import random
+import time
+import sqlite3
+import hashlib
 import lxml.etree as ET
 from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener
 from time import sleep
 #import pickle Not used as of Øystein Godøy, METNO/FOU, 2023-04-10
 from shapely.geometry import box
@@ -66,6 +83,13 @@ def parse_arguments():
     parser.add_argument('-t','--thumbnail',help='Create and index thumbnail, do not update the main content.', action='store_true')
     parser.add_argument('-n','--no_thumbnail',help='Do not index thumbnails (normally done automatically if WMS available).', action='store_true')
     parser.add_argument('-f','--no_feature',help='Do not extract featureType from files', action='store_true')
+    parser.add_argument('-b','--batch_size',help='Number of records to process at a time, these are sent to SolR in requests sized by solr-update-target-bytes. Default 2500.', type=int, default=2500)
+    parser.add_argument('-w','--workers',help='Number of worker processes used to parse, check and convert MMD files. Default 1 (no worker processes).', type=int, default=1)
+    parser.add_argument('-tw','--thumbnail_workers',help='Number of worker processes used to create thumbnails concurrently, each thumbnail limited by wms-thumbnail-timeout. Default 0 (no worker processes).', type=int, default=0)
+    parser.add_argument('-fw','--feature_workers',help='Number of worker processes used to read featureType from OPeNDAP concurrently, each dataset limited by opendap-timeout. Default 0 (no worker processes).', type=int, default=0)
+    parser.add_argument('-rft','--refresh_feature_types',help='Read featureType again for OPeNDAP URLs starting with this prefix, or for all URLs if no prefix is given, instead of using feature-type-cache.', nargs='?', const='', default=None)
+    parser.add_argument('-inc','--incremental',help='Only index files that are new or changed since they were last indexed into this core, according to the manifest (see manifest in the configuration).', action='store_true')
+    parser.add_argument('-dl','--dead_letter',help='Find records rejected by SolR by splitting failed batches, and write these to this file (JSON lines). Without this the whole batch is lost.', required=False)
 
     ### Thumbnail parameters
     parser.add_argument('-m','--map_projection',help='Specify map projection for thumbnail (e.g. Mercator, PlateCarree, PolarStereographic).', required=False)
@@ -140,6 +164,403 @@ def initialise_logger(outputfile, name):
 
     return(mylog)
 
+# Look Up Tables used in the SolR representation
+PERSONNEL_ROLE_LUT = {'Investigator':'investigator',
+                      'Technical contact': 'technical',
+                      'Metadata author': 'metadata_author',
+                      'Data center contact':'datacenter'
+}
+RELATED_INFORMATION_LUT = {'Dataset landing page':'landing_page',
+                           'Users guide': 'user_guide',
+                           'Project home page': 'home_page',
+                           'Observation facility': 'obs_facility',
+                           'Extended metadata':'ext_metadata',
+                           'Scientific publication':'scientific_publication',
+                           'Data paper':'data_paper',
+                           'Data management plan':'data_management_plan',
+                           'Other documentation':'other_documentation',
+                           'Software': 'software',
+                           'Data server landing page' : 'data_server_landing_page',
+}
+
+# Elements required in MMD
+MMD_REQUIREMENTS = [
+    'mmd:metadata_version', # Really neeeded?
+    'mmd:metadata_identifier',
+    'mmd:title',
+    'mmd:abstract',
+    'mmd:metadata_status',
+    'mmd:dataset_production_status',
+    'mmd:collection',
+    'mmd:last_metadata_update',
+    'mmd:iso_topic_category',
+    'mmd:keywords',
+]
+
+# Controlled vocabularies checked, should be collected from
+# https://github.com/steingod/scivocab/tree/master/metno
+MMD_CONTROLLED_ELEMENTS = {
+    'mmd:iso_topic_category': ['farming',
+                               'biota',
+                               'boundaries',
+                               'climatologyMeteorologyAtmosphere',
+                               'economy',
+                               'elevation',
+                               'environment',
+                               'geoscientificInformation',
+                               'health',
+                               'imageryBaseMapsEarthCover',
+                               'intelligenceMilitary',
+                               'inlandWaters',
+                               'location',
+                               'oceans',
+                               'planningCadastre',
+                               'society',
+                               'structure',
+                               'transportation',
+                               'utilitiesCommunication',
+                               'Not available'],
+    'mmd:collection': ['ACCESS',
+                       'ADC',
+                       'AeN',
+                       'APPL',
+                       'CC',
+                       'CVL',
+                       'DAM',
+                       'DOKI',
+                       'GCW',
+                       'GEONOR',
+                       'KSS',
+                       'METNCS',
+                       'NBS',
+                       'NMAP',
+                       'NMDC',
+                       'NSDN',
+                       'NySMAC',
+                       'POLARIN',
+                       'SESS2018',
+                       'SESS2019',
+                       'SESS2020',
+                       'SESS2022',
+                       'SESS2023',
+                       'SESS2024',
+                       'SESS2025',
+                       'SIOS',
+                       'SIOSAP',
+                       'SIOSCD',
+                       'SIOSIN',
+                       'TONE',
+                       'YOPP'],
+    'mmd:dataset_production_status': ['Planned',
+                                      'In Work',
+                                      'Complete',
+                                      'Obsolete',
+                                      'Not available'],
+    'mmd:quality_control': ['No quality control',
+                            'Basic quality control',
+                            'Extended quality control',
+                            'Comprehensive quality control'],
+}
+
+# Dates as normally written in MMD, these are parsed by the standard library
+ISO_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?(Z|[+-]\d{2}:\d{2})?')
+
+def parse_datetime(value):
+    """ Parse date and time, ISO 8601 strings as normally used in MMD are
+        parsed by datetime.fromisoformat, which is much faster than the
+        dateutil parser used for everything else.
+
+        Args:
+            value (str): date and time
+        Returns:
+            datetime.datetime
+    """
+    if ISO_DATETIME.fullmatch(value):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
+
+def normalise_temporal_extent(temporal_extent, logger):
+    """ Check temporal extent of MMD and normalise dates. Open ended
+        periods are placed at the end.
+
+        Args:
+            temporal_extent: mmd:temporal_extent as dictionary or list
+            logger: logger to report to
+        Returns:
+            temporal extent with normalised dates
+        Raises:
+            Exception: if the temporal extent is not valid
+    """
+    if isinstance(temporal_extent, list):
+        # Handling of multiple time periods
+        missing_none_end = 0
+        for item in temporal_extent:
+            if 'mmd:start_date' not in item or item['mmd:start_date'] is None:
+                # This exception stops further processing of records
+                raise Exception('Error in temporal specifications for the dataset')
+            else:
+                start_date = item['mmd:start_date']
+                try:
+                    start_date_parsed = parse_datetime(str(start_date))
+                    item['mmd:start_date'] = start_date_parsed.strftime("%Y-%m-%dT%H:%M:%SZ")
+                except Exception as e:
+                    logger.error('Date format could not be parsed: %s', e)
+            if 'mmd:end_date' not in item or item['mmd:end_date'] is None or item['mmd:end_date'] == '--':
+                end_date = ""
+                item['mmd:end_date'] = end_date
+                missing_none_end += 1
+            else:
+                end_date = item['mmd:end_date']
+                try:
+                    end_date_parsed = parse_datetime(str(end_date))
+                    item['mmd:end_date'] = end_date_parsed.strftime("%Y-%m-%dT%H:%M:%SZ")
+                except Exception as e:
+                    logger.error("Date format could not be parsed: %s", e)
+                # if end_date is present, check that it is smaller than start_date using dateobject
+                if end_date_parsed < start_date_parsed:
+                    raise Exception('Start and end dates are in the wrong order')
+        # check that only 1 pair has open ended
+        if missing_none_end > 1:
+            raise Exception('More than one open ended temporal extent')
+        else:
+            # place the open ended at the end
+            temporal_extent = sorted(temporal_extent, key=lambda d: not d['mmd:end_date'])
+    else:
+        # Handling of datasets with only one period
+        for mykey in temporal_extent:
+            """
+            FIXME, skip record if start_date not specified
+            """
+            if mykey == '@xmlns:gml':
+                continue
+            # Start date always have to be present
+            if (temporal_extent['mmd:start_date'] == None):
+                # This exception stops further processing of records
+                raise Exception('Error in temporal specifications for the dataset')
+            #print('##### So far so good...')
+            #print(temporal_extent)
+            # Checking end_date that is not mandatory but is sometimes set empty instead of missing
+            if mykey == 'mmd:end_date':
+                if (temporal_extent['mmd:end_date'] == None) or (temporal_extent['mmd:end_date'] == '--'):
+                    mydate = ''
+                    temporal_extent[mykey] = mydate
+            if temporal_extent[mykey] != '':
+                """
+                If start_date is missing, won't come here...
+                Skip this step for empty mydate
+                """
+                try:
+                    mydate = parse_datetime(str(temporal_extent[mykey]))
+                    temporal_extent[mykey] = mydate.strftime('%Y-%m-%dT%H:%M:%SZ')
+                except Exception as e:
+                    logger.error('Date format could not be parsed: %s', e)
+                    raise Exception('Error in temporal specifications for the dataset')
+        # if end_date is present, check that it is smaller than start_date using dateobject
+        if 'mmd:end_date' in temporal_extent and temporal_extent['mmd:end_date'] !='':
+            if temporal_extent['mmd:end_date'] < temporal_extent['mmd:start_date']:
+                raise Exception('Start and end dates are in the wrong order')
+
+    return temporal_extent
+
+def add_temporal_extent(mydict, temporal_extent, logger):
+    """ Add temporal extent, checked by normalise_temporal_extent, to
+        the SolR representation in mydict
+    """
+    if isinstance(temporal_extent, list):
+        mydict["temporal_extent_start_date"] = []
+        mydict["temporal_extent_end_date"] = []
+        mydict["temporal_extent_period_dr"] = []
+        for item in temporal_extent:
+            mytime = parse_datetime(item["mmd:start_date"])
+            mydict["temporal_extent_start_date"].append(mytime.strftime("%Y-%m-%dT%H:%M:%SZ"))
+            st = item["mmd:start_date"]
+            if item["mmd:end_date"]:
+                mytime = parse_datetime(item["mmd:end_date"])
+                mydict["temporal_extent_end_date"].append(mytime.strftime("%Y-%m-%dT%H:%M:%SZ"))
+                end = item["mmd:end_date"]
+                logger.debug("Creating daterange with end date")
+                mydict["temporal_extent_period_dr"].append("[" + st + " TO " + end + "]")
+            else:
+                logger.debug("Creating daterange with open end date")
+                mydict["temporal_extent_period_dr"].append("[" + st + " TO *]")
+    else:
+        mydict["temporal_extent_start_date"] = str(temporal_extent['mmd:start_date'])
+        if 'mmd:end_date' in temporal_extent:
+            if temporal_extent['mmd:end_date'] is not None:
+                mydict["temporal_extent_end_date"] = str(temporal_extent['mmd:end_date'])
+
+        if "temporal_extent_end_date" in mydict:
+            logger.debug('Creating daterange with end date')
+            st = str(mydict["temporal_extent_start_date"])
+            end = str(mydict["temporal_extent_end_date"])
+            mydict['temporal_extent_period_dr'] = '[' + st + ' TO ' + end + ']'
+        else:
+            st = str(mydict["temporal_extent_start_date"])
+            mydict['temporal_extent_period_dr'] = '[' + st + ' TO *]'
+        logger.info("Temporal extent date range: %s", mydict['temporal_extent_period_dr'])
+
+def add_personnel(mydict, personnel_elements, logger):
+    """ Add mmd:personnel elements to the SolR representation in mydict """
+
+    if isinstance(personnel_elements, dict): #Only one element
+        personnel_elements = [personnel_elements] # make it an iterable list
+
+    # Facet elements
+    mydict['personnel_role'] = []
+    mydict['personnel_name'] = []
+    mydict['personnel_organisation'] = []
+    # Fix role based lists
+    for role in PERSONNEL_ROLE_LUT:
+        mydict['personnel_{}_role'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_name'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_email'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_phone'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_fax'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_organisation'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_address'.format(PERSONNEL_ROLE_LUT[role])] = []
+        # don't think this is needed Øystein Godøy, METNO/FOU, 2021-09-08 mydict['personnel_{}_address_address'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_address_city'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_address_province_or_state'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_address_postal_code'.format(PERSONNEL_ROLE_LUT[role])] = []
+        mydict['personnel_{}_address_country'.format(PERSONNEL_ROLE_LUT[role])] = []
+
+    # Fill lists with information
+    for personnel in personnel_elements:
+        role = personnel['mmd:role']
+        if not role:
+            logger.warning('No role available for personnel')
+            break
+        if role not in PERSONNEL_ROLE_LUT:
+            logger.warning('Wrong role provided for personnel')
+            break
+        for entry in personnel:
+            entry_type = entry.split(':')[-1]
+            if entry_type == 'role':
+                mydict['personnel_{}_role'.format(PERSONNEL_ROLE_LUT[role])].append(personnel[entry])
+                mydict['personnel_role'].append(personnel[entry])
+            elif entry_type == 'type':
+                pass
+            else:
+                # Treat address specifically and handle faceting elements personnel_role, personnel_name, personnel_organisation.
+                if entry_type == 'contact_address':
+                    for el in personnel[entry]:
+                        el_type = el.split(':')[-1]
+                        if el_type == 'address':
+                            mydict['personnel_{}_{}'.format(PERSONNEL_ROLE_LUT[role], el_type)].append(personnel[entry][el])
+                        else:
+                            mydict['personnel_{}_address_{}'.format(PERSONNEL_ROLE_LUT[role], el_type)].append(personnel[entry][el])
+                elif entry_type == 'name':
+                    if isinstance(personnel[entry], dict):
+                        name = personnel[entry]['#text']
+                    else:
+                        name = personnel[entry]
+                    mydict['personnel_{}_{}'.format(PERSONNEL_ROLE_LUT[role], entry_type)].append(name)
+                    mydict['personnel_name'].append(name)
+                elif entry_type == 'organisation':
+                    if isinstance(personnel[entry], dict):
+                        organisation = personnel[entry]['#text']
+                    else:
+                        organisation = personnel[entry]
+                    mydict['personnel_{}_{}'.format(PERSONNEL_ROLE_LUT[role], entry_type)].append(organisation)
+                    mydict['personnel_organisation'].append(organisation)
+                else:
+                    mydict['personnel_{}_{}'.format(PERSONNEL_ROLE_LUT[role], entry_type)].append(personnel[entry])
+
+def add_data_center(mydict, data_center_elements):
+    """ Add mmd:data_center elements to the SolR representation in mydict """
+    if isinstance(data_center_elements, dict): #Only one element
+        data_center_elements = [data_center_elements] # make it an iterable list
+
+    for data_center in data_center_elements: #iterate over all data_center elements
+        for key,value in data_center.items():
+            if isinstance(value,dict): # if sub element is ordered dict
+                for kkey, vvalue in value.items():
+                    element_name = 'data_center_{}'.format(kkey.split(':')[-1])
+                    if not element_name in mydict.keys(): # create key in mydict
+                        mydict[element_name] = []
+                        mydict[element_name].append(vvalue)
+                    else:
+                        mydict[element_name].append(vvalue)
+            else: #sub element is not ordered dicts
+                element_name = '{}'.format(key.split(':')[-1])
+                if not element_name in mydict.keys(): # create key in mydict. Repetition of above. Should be simplified.
+                    mydict[element_name] = []
+                    mydict[element_name].append(value)
+                else:
+                    mydict[element_name].append(value)
+
+def add_platform(mydict, platform_elements):
+    """ Add mmd:platform elements to the SolR representation in mydict """
+    if isinstance(platform_elements, dict): #Only one element
+        platform_elements = [platform_elements] # make it an iterable list
+    elif isinstance(platform_elements, str):
+        # If comma separated string (by some reason), split...
+        platform_elements = platform_elements.split(',')
+
+    for platform in platform_elements:
+        print(platform)
+        for platform_key, platform_value in platform.items():
+            if isinstance(platform_value,dict): # if sub element is ordered dict
+                print('Platform is in a dict...')
+                for kkey, vvalue in platform_value.items():
+                    element_name = 'platform_{}_{}'.format(platform_key.split(':')[-1],kkey.split(':')[-1])
+                    if not element_name in mydict.keys(): # create key in mydict
+                        mydict[element_name] = []
+                        mydict[element_name].append(vvalue)
+                    else:
+                        mydict[element_name].append(vvalue)
+            else: #sub element is not ordered dicts
+                print('Issue with platform as not a dict...')
+                element_name = 'platform_{}'.format(platform_key.split(':')[-1])
+                if not element_name in mydict.keys(): # create key in mydict. Repetition of above. Should be simplified.
+                    mydict[element_name] = []
+                    mydict[element_name].append(platform_value)
+                else:
+                    mydict[element_name].append(platform_value)
+
+        # Add platform_sentinel for NBS
+        initial_platform = mydict['platform_long_name'][0]
+        if initial_platform is not None:
+            if initial_platform.startswith('Sentinel'):
+                mydict['platform_sentinel'] = initial_platform[:-1]
+
+def add_dataset_citation(mydict, dataset_citation_elements):
+    """ Add mmd:dataset_citation elements to the SolR representation in mydict """
+    #Only one element
+    if isinstance(dataset_citation_elements, dict):
+        # make it an iterable list
+        dataset_citation_elements = [dataset_citation_elements]
+
+    if dataset_citation_elements is not None:
+        for dataset_citation in dataset_citation_elements:
+            for k, v in dataset_citation.items():
+                element_suffix = k.split(':')[-1]
+                """
+                Fix to handle IMR records
+                Consider to add to MMD/SolR in the future
+                """
+                if element_suffix == "edition":
+                    continue
+                """
+                Fix issue between MMD and SolR schema, SolR requires full datetime, MMD not. Also fix any errors in harvested data...
+                """
+                if element_suffix == 'publication_date':
+                    if v is None or "Not Available" in v or len(v) < 10:
+                        continue
+                    # Check if time format is correct
+                    if re.search("T\d{2}:\d{2}:\d{2}:\d{2}Z", v):
+                        tmpstr = re.sub("T\d{2}:\d{2}:\d{2}:\d{2}Z", "T12:00:00Z", v)
+                        v = tmpstr
+                    elif re.search('T\d{2}:\d{2}:\d{2}', v):
+                        if not re.search('Z$', v):
+                            v += 'Z'
+                    elif not re.search("T\d{2}:\d{2}:\d{2}Z", v):
+                        v += 'T12:00:00Z'
+                mydict['dataset_citation_{}'.format(element_suffix)] = v
+
 class MMD4SolR:
     """ Read and check MMD files, convert to dictionary """
 
@@ -149,9 +570,12 @@ class MMD4SolR:
         self.logger.info('Creating an instance of MMD4SolR')
         """ set variables in class """
         self.filename = filename
+        # The file is read and parsed once, the raw bytes are kept for
+        # the base64 representation added by tosolr.
         try:
-            with open(self.filename, encoding='utf-8') as fd:
-                self.mydoc = xmltodict.parse(fd.read())
+            with open(self.filename, 'rb') as fd:
+                self.mmd_xml = fd.read()
+            self.mydoc = xmltodict.parse(self.mmd_xml)
         except Exception as e:
             self.logger.error('Could not open file: %s',self.filename)
             raise
@@ -172,18 +596,7 @@ class MMD4SolR:
         """
         # TODO add proper docstring
         self.logger.info('Checking for MMD minimum requirements')
-        mmd_requirements = {
-            'mmd:metadata_version': False, # Really neeeded?
-            'mmd:metadata_identifier': False,
-            'mmd:title': False,
-            'mmd:abstract': False,
-            'mmd:metadata_status': False,
-            'mmd:dataset_production_status': False,
-            'mmd:collection': False,
-            'mmd:last_metadata_update': False,
-            'mmd:iso_topic_category': False,
-            'mmd:keywords': False,
-        }
+        mmd_requirements = dict((requirement, False) for requirement in MMD_REQUIREMENTS)
         """
         Check for presence and non empty elements
         This must be further developed...
@@ -208,68 +621,7 @@ class MMD4SolR:
         Should be collected from
             https://github.com/steingod/scivocab/tree/master/metno
         """
-        mmd_controlled_elements = {
-            'mmd:iso_topic_category': ['farming',
-                                       'biota',
-                                       'boundaries',
-                                       'climatologyMeteorologyAtmosphere',
-                                       'economy',
-                                       'elevation',
-                                       'environment',
-                                       'geoscientificInformation',
-                                       'health',
-                                       'imageryBaseMapsEarthCover',
-                                       'intelligenceMilitary',
-                                       'inlandWaters',
-                                       'location',
-                                       'oceans',
-                                       'planningCadastre',
-                                       'society',
-                                       'structure',
-                                       'transportation',
-                                       'utilitiesCommunication',
-                                       'Not available'],
-            'mmd:collection': ['ACCESS',
-                               'ADC',
-                               'AeN',
-                               'APPL',
-                               'CC',
-                               'CVL',
-                               'DAM',
-                               'DOKI',
-                               'GCW',
-                               'GEONOR',
-                               'KSS',
-                               'METNCS',
-                               'NBS',
-                               'NMAP',
-                               'NMDC',
-                               'NSDN',
-                               'NySMAC',
-                               'POLARIN',
-                               'SESS2018',
-                               'SESS2019',
-                               'SESS2020',
-                               'SESS2022',
-                               'SESS2023',
-                               'SESS2024',
-                               'SESS2025',
-                               'SIOS',
-                               'SIOSAP',
-                               'SIOSCD',
-                               'SIOSIN',
-                               'TONE',
-                               'YOPP'],
-            'mmd:dataset_production_status': ['Planned',
-                                              'In Work',
-                                              'Complete',
-                                              'Obsolete',
-                                              'Not available'],
-            'mmd:quality_control': ['No quality control',
-                                    'Basic quality control',
-                                    'Extended quality control',
-                                    'Comprehensive quality control'],
-        }
+        mmd_controlled_elements = MMD_CONTROLLED_ELEMENTS
         for element in mmd_controlled_elements.keys():
             #self.logger.info('\n\tChecking %s\n\tfor compliance with controlled vocabulary', element)
             if element in self.mydoc['mmd:mmd']:
@@ -351,109 +703,23 @@ class MMD4SolR:
                     myvalue = self.mydoc['mmd:mmd']['mmd:last_metadata_update']
                 else:
                     myvalue = self.mydoc['mmd:mmd']['mmd:last_metadata_update']+'Z'
-            mydate = dateutil.parser.parse(myvalue)
+            mydate = parse_datetime(myvalue)
             #self.mydoc['mmd:mmd']['mmd:last_metadata_update'] = mydate.strftime('%Y-%m-%dT%H:%M:%SZ')
         """
         FIXME
         Noe er galt med tidssjekken, dokumenter kommer gjennom
         """
         if 'mmd:temporal_extent' in self.mydoc['mmd:mmd']:
-            if isinstance(self.mydoc['mmd:mmd']['mmd:temporal_extent'], list):
-                # Handling of multiple time periods
-                missing_none_end = 0
-                for item in self.mydoc['mmd:mmd']['mmd:temporal_extent']:
-                    if 'mmd:start_date' not in item or item['mmd:start_date'] is None:
-                        # This exception stops further processing of records
-                        raise Exception('Error in temporal specifications for the dataset')
-                    else:
-                        start_date = item['mmd:start_date']
-                        try:
-                            start_date_parsed = dateutil.parser.parse(str(start_date))
-                            item['mmd:start_date'] = start_date_parsed.strftime("%Y-%m-%dT%H:%M:%SZ")
-                        except Exception as e:
-                            self.logger.error('Date format could not be parsed: %s', e)
-                    if 'mmd:end_date' not in item or item['mmd:end_date'] is None or item['mmd:end_date'] == '--':
-                        end_date = ""
-                        item['mmd:end_date'] = end_date
-                        missing_none_end += 1
-                    else:
-                        end_date = item['mmd:end_date']
-                        try:
-                            end_date_parsed = dateutil.parser.parse(str(end_date))
-                            item['mmd:end_date'] = end_date_parsed.strftime("%Y-%m-%dT%H:%M:%SZ")
-                        except Exception as e:
-                            self.logger.error("Date format could not be parsed: %s", e)
-                        # if end_date is present, check that it is smaller than start_date using dateobject
-                        if end_date_parsed < start_date_parsed:
-                            raise Exception('Start and end dates are in the wrong order')
-                # check that only 1 pair has open ended
-                if missing_none_end > 1:
-                    raise Exception('More than one open ended temporal extent')
-                else:
-                    # place the open ended at the end
-                    self.mydoc['mmd:mmd']["mmd:temporal_extent"] = sorted(self.mydoc['mmd:mmd']["mmd:temporal_extent"], key=lambda d: not d['mmd:end_date'])
-            else:
-                # Handling of datasets with only one period
-                for mykey in self.mydoc['mmd:mmd']['mmd:temporal_extent']:
-                    """
-                    FIXME, skip record if start_date not specified
-                    """
-                    if mykey == '@xmlns:gml':
-                        continue
-                    # Start date always have to be present
-                    if (self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:start_date'] == None):
-                        # This exception stops further processing of records
-                        raise Exception('Error in temporal specifications for the dataset')
-                    #print('##### So far so good...')
-                    #print(self.mydoc['mmd:mmd']['mmd:temporal_extent'])
-                    # Checking end_date that is not mandatory but is sometimes set empty instead of missing
-                    if mykey == 'mmd:end_date':
-                        if (self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:end_date'] == None) or (self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:end_date'] == '--'):
-                            mydate = ''
-                            self.mydoc['mmd:mmd']['mmd:temporal_extent'][mykey] = mydate
-                    if self.mydoc['mmd:mmd']['mmd:temporal_extent'][mykey] != '':
-                        """
-                        If start_date is missing, won't come here...
-                        Skip this step for empty mydate
-                        """
-                        try:
-                            mydate = dateutil.parser.parse(str(self.mydoc['mmd:mmd']['mmd:temporal_extent'][mykey]))
-                            self.mydoc['mmd:mmd']['mmd:temporal_extent'][mykey] = mydate.strftime('%Y-%m-%dT%H:%M:%SZ')
-                        except Exception as e:
-                            self.logger.error('Date format could not be parsed: %s', e)
-                            raise Exception('Error in temporal specifications for the dataset')
-                # if end_date is present, check that it is smaller than start_date using dateobject
-                if 'mmd:end_date' in self.mydoc['mmd:mmd']['mmd:temporal_extent'] and self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:end_date'] !='':
-                    if self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:end_date'] < self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:start_date']:
-                        raise Exception('Start and end dates are in the wrong order')
+            self.mydoc['mmd:mmd']['mmd:temporal_extent'] = normalise_temporal_extent(
+                    self.mydoc['mmd:mmd']['mmd:temporal_extent'], self.logger)
 
     def tosolr(self):
         """
         Method for creating document with SolR representation of MMD according
         to the XSD.
         """
-
         self.logger.info('Converting to SolR format')
 
-        # Defining Look Up Tables
-        personnel_role_LUT = {'Investigator':'investigator',
-                              'Technical contact': 'technical',
-                              'Metadata author': 'metadata_author',
-                              'Data center contact':'datacenter'
-                             }
-        related_information_LUT = {'Dataset landing page':'landing_page',
-                              'Users guide': 'user_guide',
-                              'Project home page': 'home_page',
-                              'Observation facility': 'obs_facility',
-                              'Extended metadata':'ext_metadata',
-                              'Scientific publication':'scientific_publication',
-                              'Data paper':'data_paper',
-                              'Data management plan':'data_management_plan',
-                              'Other documentation':'other_documentation',
-                              'Software': 'software',
-                              'Data server landing page' : 'data_server_landing_page',
-                             }
-
         # Create OrderedDict which will contain all elements for SolR
         mydict = OrderedDict()
 
@@ -574,38 +840,7 @@ class MMD4SolR:
 
         """ Temporal extent """
         if 'mmd:temporal_extent' in self.mydoc['mmd:mmd']:
-            if isinstance(self.mydoc['mmd:mmd']['mmd:temporal_extent'], list):
-                mydict["temporal_extent_start_date"] = []
-                mydict["temporal_extent_end_date"] = []
-                mydict["temporal_extent_period_dr"] = []
-                for item in self.mydoc['mmd:mmd']['mmd:temporal_extent']:
-                    mytime = dateutil.parser.parse(item["mmd:start_date"])
-                    mydict["temporal_extent_start_date"].append(mytime.strftime("%Y-%m-%dT%H:%M:%SZ"))
-                    st = item["mmd:start_date"]
-                    if item["mmd:end_date"]:
-                        mytime = dateutil.parser.parse(item["mmd:end_date"])
-                        mydict["temporal_extent_end_date"].append(mytime.strftime("%Y-%m-%dT%H:%M:%SZ"))
-                        end = item["mmd:end_date"]
-                        self.logger.debug("Creating daterange with end date")
-                        mydict["temporal_extent_period_dr"].append("[" + st + " TO " + end + "]")
-                    else:
-                        self.logger.debug("Creating daterange with open end date")
-                        mydict["temporal_extent_period_dr"].append("[" + st + " TO *]")
-            else:
-                mydict["temporal_extent_start_date"] = str(self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:start_date'])
-                if 'mmd:end_date' in self.mydoc['mmd:mmd']['mmd:temporal_extent']:
-                    if self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:end_date'] is not None:
-                        mydict["temporal_extent_end_date"] = str(self.mydoc['mmd:mmd']['mmd:temporal_extent']['mmd:end_date'])
-
-                if "temporal_extent_end_date" in mydict:
-                    self.logger.debug('Creating daterange with end date')
-                    st = str(mydict["temporal_extent_start_date"])
-                    end = str(mydict["temporal_extent_end_date"])
-                    mydict['temporal_extent_period_dr'] = '[' + st + ' TO ' + end + ']'
-                else:
-                    st = str(mydict["temporal_extent_start_date"])
-                    mydict['temporal_extent_period_dr'] = '[' + st + ' TO *]'
-                self.logger.info("Temporal extent date range: %s", mydict['temporal_extent_period_dr'])
+            add_temporal_extent(mydict, self.mydoc['mmd:mmd']['mmd:temporal_extent'], self.logger)
 
         """ Geographical extent """
         """ Assumes longitudes positive eastwards and in the are -180:180
@@ -774,98 +1009,12 @@ class MMD4SolR:
         """ Personnel """
         #self.logger.info("Processing dataset personnel")
         if 'mmd:personnel' in self.mydoc['mmd:mmd']:
-            personnel_elements = self.mydoc['mmd:mmd']['mmd:personnel']
-
-            if isinstance(personnel_elements, dict): #Only one element
-                personnel_elements = [personnel_elements] # make it an iterable list
-
-            # Facet elements
-            mydict['personnel_role'] = []
-            mydict['personnel_name'] = []
-            mydict['personnel_organisation'] = []
-            # Fix role based lists
-            for role in personnel_role_LUT:
-                mydict['personnel_{}_role'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_name'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_email'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_phone'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_fax'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_organisation'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_address'.format(personnel_role_LUT[role])] = []
-                # don't think this is needed Øystein Godøy, METNO/FOU, 2021-09-08 mydict['personnel_{}_address_address'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_address_city'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_address_province_or_state'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_address_postal_code'.format(personnel_role_LUT[role])] = []
-                mydict['personnel_{}_address_country'.format(personnel_role_LUT[role])] = []
-
-            # Fill lists with information
-            for personnel in personnel_elements:
-                role = personnel['mmd:role']
-                if not role:
-                    self.logger.warning('No role available for personnel')
-                    break
-                if role not in personnel_role_LUT:
-                    self.logger.warning('Wrong role provided for personnel')
-                    break
-                for entry in personnel:
-                    entry_type = entry.split(':')[-1]
-                    if entry_type == 'role':
-                        mydict['personnel_{}_role'.format(personnel_role_LUT[role])].append(personnel[entry])
-                        mydict['personnel_role'].append(personnel[entry])
-                    elif entry_type == 'type':
-                        pass
-                    else:
-                        # Treat address specifically and handle faceting elements personnel_role, personnel_name, personnel_organisation.
-                        if entry_type == 'contact_address':
-                            for el in personnel[entry]:
-                                el_type = el.split(':')[-1]
-                                if el_type == 'address':
-                                    mydict['personnel_{}_{}'.format(personnel_role_LUT[role], el_type)].append(personnel[entry][el])
-                                else:
-                                    mydict['personnel_{}_address_{}'.format(personnel_role_LUT[role], el_type)].append(personnel[entry][el])
-                        elif entry_type == 'name':
-                            if isinstance(personnel[entry], dict):
-                                name = personnel[entry]['#text']
-                            else:
-                                name = personnel[entry]
-                            mydict['personnel_{}_{}'.format(personnel_role_LUT[role], entry_type)].append(name)
-                            mydict['personnel_name'].append(name)
-                        elif entry_type == 'organisation':
-                            if isinstance(personnel[entry], dict):
-                                organisation = personnel[entry]['#text']
-                            else:
-                                organisation = personnel[entry]
-                            mydict['personnel_{}_{}'.format(personnel_role_LUT[role], entry_type)].append(organisation)
-                            mydict['personnel_organisation'].append(organisation)
-                        else:
-                            mydict['personnel_{}_{}'.format(personnel_role_LUT[role], entry_type)].append(personnel[entry])
+            add_personnel(mydict, self.mydoc['mmd:mmd']['mmd:personnel'], self.logger)
 
         """ Data center """
         #self.logger.info("Processing data center")
         if 'mmd:data_center' in self.mydoc['mmd:mmd']:
-
-            data_center_elements = self.mydoc['mmd:mmd']['mmd:data_center']
-
-            if isinstance(data_center_elements, dict): #Only one element
-                data_center_elements = [data_center_elements] # make it an iterable list
-
-            for data_center in data_center_elements: #elf.mydoc['mmd:mmd']['mmd:data_center']: #iterate over all data_center elements
-                for key,value in data_center.items():
-                    if isinstance(value,dict): # if sub element is ordered dict
-                        for kkey, vvalue in value.items():
-                            element_name = 'data_center_{}'.format(kkey.split(':')[-1])
-                            if not element_name in mydict.keys(): # create key in mydict
-                                mydict[element_name] = []
-                                mydict[element_name].append(vvalue)
-                            else:
-                                mydict[element_name].append(vvalue)
-                    else: #sub element is not ordered dicts
-                        element_name = '{}'.format(key.split(':')[-1])
-                        if not element_name in mydict.keys(): # create key in mydict. Repetition of above. Should be simplified.
-                            mydict[element_name] = []
-                            mydict[element_name].append(value)
-                        else:
-                            mydict[element_name].append(value)
+            add_data_center(mydict, self.mydoc['mmd:mmd']['mmd:data_center'])
         else:
             # FIXME remember to handle missing data centre, set NA
             pass
@@ -954,18 +1103,18 @@ class MMD4SolR:
 
             for related_information in related_information_elements:
                 value = related_information['mmd:type']
-                if value in related_information_LUT.keys():
+                if value in RELATED_INFORMATION_LUT.keys():
                     #if list does not exist, create it
-                    if 'related_url_{}'.format(related_information_LUT[value]) not in mydict.keys():
-                        mydict['related_url_{}'.format(related_information_LUT[value])] = []
-                        mydict['related_url_{}_desc'.format(related_information_LUT[value])] = []
+                    if 'related_url_{}'.format(RELATED_INFORMATION_LUT[value]) not in mydict.keys():
+                        mydict['related_url_{}'.format(RELATED_INFORMATION_LUT[value])] = []
+                        mydict['related_url_{}_desc'.format(RELATED_INFORMATION_LUT[value])] = []
 
                     #append elements to lists
-                    mydict['related_url_{}'.format(related_information_LUT[value])].append(related_information['mmd:resource'])
+                    mydict['related_url_{}'.format(RELATED_INFORMATION_LUT[value])].append(related_information['mmd:resource'])
                     if 'mmd:description' in related_information and related_information['mmd:description'] is not None:
-                        mydict['related_url_{}_desc'.format(related_information_LUT[value])].append(related_information['mmd:description'])
+                        mydict['related_url_{}_desc'.format(RELATED_INFORMATION_LUT[value])].append(related_information['mmd:description'])
                     else:
-                        mydict['related_url_{}_desc'.format(related_information_LUT[value])].append('Not Available')
+                        mydict['related_url_{}_desc'.format(RELATED_INFORMATION_LUT[value])].append('Not Available')
 
         """
         ISO TopicCategory
@@ -1060,39 +1209,7 @@ class MMD4SolR:
         #self.logger.info("Processing platform")
         # FIXME add check for empty sub elements...
         if 'mmd:platform' in self.mydoc['mmd:mmd']:
-            platform_elements = self.mydoc['mmd:mmd']['mmd:platform']
-            if isinstance(platform_elements, dict): #Only one element
-                platform_elements = [platform_elements] # make it an iterable list
-            elif isinstance(platform_elements, str):
-                # If comma separated string (by some reason), split...
-                platform_elements = platform_elements.split(',')
-
-            for platform in platform_elements:
-                print(platform)
-                for platform_key, platform_value in platform.items():
-                    if isinstance(platform_value,dict): # if sub element is ordered dict
-                        print('Platform is in a dict...')
-                        for kkey, vvalue in platform_value.items():
-                            element_name = 'platform_{}_{}'.format(platform_key.split(':')[-1],kkey.split(':')[-1])
-                            if not element_name in mydict.keys(): # create key in mydict
-                                mydict[element_name] = []
-                                mydict[element_name].append(vvalue)
-                            else:
-                                mydict[element_name].append(vvalue)
-                    else: #sub element is not ordered dicts
-                        print('Issue with platform as not a dict...')
-                        element_name = 'platform_{}'.format(platform_key.split(':')[-1])
-                        if not element_name in mydict.keys(): # create key in mydict. Repetition of above. Should be simplified.
-                            mydict[element_name] = []
-                            mydict[element_name].append(platform_value)
-                        else:
-                            mydict[element_name].append(platform_value)
-
-                # Add platform_sentinel for NBS
-                initial_platform = mydict['platform_long_name'][0]
-                if initial_platform is not None:
-                    if initial_platform.startswith('Sentinel'):
-                        mydict['platform_sentinel'] = initial_platform[:-1]
+            add_platform(mydict, self.mydoc['mmd:mmd']['mmd:platform'])
 
         """ Activity type """
         #self.logger.info("Processing activity type")
@@ -1107,39 +1224,7 @@ class MMD4SolR:
         """ Dataset citation """
         #self.logger.info("Processing dataset citation")
         if 'mmd:dataset_citation' in self.mydoc['mmd:mmd']:
-            dataset_citation_elements = self.mydoc['mmd:mmd']['mmd:dataset_citation']
-
-            #Only one element
-            if isinstance(dataset_citation_elements, dict):
-                # make it an iterable list
-                dataset_citation_elements = [dataset_citation_elements]
-
-            if dataset_citation_elements is not None:
-                for dataset_citation in dataset_citation_elements:
-                    for k, v in dataset_citation.items():
-                        element_suffix = k.split(':')[-1]
-                        """
-                        Fix to handle IMR records
-                        Consider to add to MMD/SolR in the future
-                        """
-                        if element_suffix == "edition":
-                            continue
-                        """
-                        Fix issue between MMD and SolR schema, SolR requires full datetime, MMD not. Also fix any errors in harvested data...
-                        """
-                        if element_suffix == 'publication_date':
-                            if v is None or "Not Available" in v or len(v) < 10:
-                                continue
-                            # Check if time format is correct
-                            if re.search("T\d{2}:\d{2}:\d{2}:\d{2}Z", v):
-                                tmpstr = re.sub("T\d{2}:\d{2}:\d{2}:\d{2}Z", "T12:00:00Z", v)
-                                v = tmpstr
-                            elif re.search('T\d{2}:\d{2}:\d{2}', v):
-                                if not re.search('Z$', v):
-                                    v += 'Z'
-                            elif not re.search("T\d{2}:\d{2}:\d{2}Z", v):
-                                v += 'T12:00:00Z'
-                        mydict['dataset_citation_{}'.format(element_suffix)] = v
+            add_dataset_citation(mydict, self.mydoc['mmd:mmd']['mmd:dataset_citation'])
 
         """
         Quality control
@@ -1150,10 +1235,7 @@ class MMD4SolR:
 
         """ Adding MMD document as base64 string"""
         self.logger.info("Packaging MMD XML as base64 string")
-        # Check if this can be simplified in the workflow.
-        xml_root = ET.parse(str(self.filename))
-        xml_string = ET.tostring(xml_root)
-        encoded_xml_string = base64.b64encode(xml_string)
+        encoded_xml_string = base64.b64encode(self.mmd_xml)
         xml_b64 = (encoded_xml_string).decode('utf-8')
         mydict['mmd_xml_file'] = xml_b64
 
@@ -1170,12 +1252,1021 @@ class MMD4SolR:
 
         return mydict
 
+# Errors from pysolr that are worth retrying: server errors (HTTP 5xx),
+# timeouts and failures to connect
+SOLR_RETRY_ERROR = re.compile(r'Solr responded with an error \(HTTP 5\d\d\)|timed out|Failed to connect')
+
+# Maximum length of the ids parameter in real-time get requests, URLs
+# longer than 8 KiB are rejected by many servers and proxies
+MAX_GET_IDS_LENGTH = 4000
+
+# Feature types getting a sparkline thumbnail, and the most values read
+# for it
+TS_FEATURE_TYPES = ('timeSeries', 'trajectory', 'profile')
+TS_THUMBNAIL_POINTS = 500
+# Most values of the index variable of indexed ragged arrays read to find
+# the samples of the first instance
+TS_THUMBNAIL_INDEX_POINTS = 20*TS_THUMBNAIL_POINTS
+# Most points read in each direction for quicklooks of gridded datasets
+GRID_THUMBNAIL_SIZE = 300
+
+def document_size(doc):
+    """ Approximate size in bytes of a SolR document in an update request """
+    size = 16
+    for key, value in doc.items():
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                size += len(key) + len(str(item)) + 24
+        else:
+            size += len(key) + len(str(value)) + 24
+    return size
+
+class SolrSubmitter:
+    """ Submit documents to SolR in a pool of threads, with at most
+    max_inflight update requests waiting for SolR at any time. Documents
+    are collected into update requests of about target_bytes (never more
+    than max_bytes unless a single document is larger). With
+    target_latency given, target_bytes is halved when requests are slower
+    than this and grown slowly when they are much faster. Requests
+    failing with server errors or timeouts are retried with exponential
+    backoff. If a dead letter file is given, batches rejected by SolR
+    are split recursively to find the offending documents, which are
+    written to the file while the rest are indexed. Completion callbacks
+    are run in the thread calling submit or flush, not in the pool. With
+    field_updates given, e.g. {'isParent': 'set'}, the documents are sent
+    as atomic updates of these fields.
+    """
+
+    # Lower limit of target_bytes when adapting to latency
+    min_bytes = 64*1024
+
+    def __init__(self, solrc, max_inflight=1, retries=3, backoff=2.0, deadletter=None,
+                 target_bytes=8*1024*1024, max_bytes=32*1024*1024, target_latency=None,
+                 field_updates=None):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.SolrSubmitter')
+        self.solrc = solrc
+        self.field_updates = field_updates
+        self.max_inflight = max(1, max_inflight)
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_inflight)
+        self.inflight = dict()
+        # Size of requests
+        self.max_bytes = max_bytes
+        self.target_bytes = min(target_bytes, max_bytes)
+        self.target_latency = target_latency
+        # Documents waiting to be sent, with sizes and completion callbacks
+        self.pending = []
+        self.pending_bytes = 0
+        # Documents rejected by SolR, one JSON object per line
+        self.deadletter = None
+        if deadletter is not None:
+            self.deadletter = open(deadletter, 'a')
+        # Counters
+        self.lock = threading.Lock()
+        self.started = None
+        self.nodocs = 0
+        self.norequests = 0
+        self.noretries = 0
+        self.nofailed = 0
+        self.norejected = 0
+        self.latency = 0.
+        self.maxlatency = 0.
+
+    def post(self, records):
+        """ Post records to SolR, retrying transient errors
+
+            Args:
+                records (list): SolR documents
+            Returns:
+                Exception: None if SolR accepted the records, otherwise
+                           the last error
+        """
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                self.solrc.add(records, fieldUpdates=self.field_updates)
+                error = None
+            except Exception as e:
+                error = e
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.norequests += 1
+                self.latency += elapsed
+                self.maxlatency = max(self.maxlatency, elapsed)
+                if error is None:
+                    self.nodocs += len(records)
+                if error is None or 'timed out' in str(error):
+                    self.adapt(elapsed)
+            if error is None:
+                return None
+            if attempt >= self.retries or not SOLR_RETRY_ERROR.search(str(error)):
+                with self.lock:
+                    self.nofailed += 1
+                return error
+            delay = self.backoff * 2**attempt * random.uniform(0.5, 1.)
+            self.logger.warning('SolR update failed (%s), retrying in %.1f s', str(error), delay)
+            with self.lock:
+                self.noretries += 1
+            sleep(delay)
+            attempt += 1
+
+    def send(self, records):
+        """ Send records to SolR. This is run in the pool.
+
+            Args:
+                records (list): SolR documents
+            Returns:
+                list: records not accepted by SolR
+        """
+        error = self.post(records)
+        if error is None:
+            return []
+        # Only batches rejected because of their content are split,
+        # server errors are not caused by single documents.
+        if self.deadletter is None or SOLR_RETRY_ERROR.search(str(error)):
+            self.logger.error("Something failed in SolR adding document: %s", str(error))
+            return records
+        if len(records) == 1:
+            self.reject(records[0], error)
+            return records
+        self.logger.warning('SolR rejected a batch of %d records, splitting it: %s', len(records), str(error))
+        middle = len(records)//2
+        return self.send(records[:middle]) + self.send(records[middle:])
+
+    def adapt(self, elapsed):
+        """ Adjust target_bytes to the latency of the last request """
+        if self.target_latency is None:
+            return
+        if elapsed > self.target_latency:
+            target_bytes = max(min(self.min_bytes, self.target_bytes), self.target_bytes//2)
+        elif elapsed < self.target_latency/2:
+            target_bytes = min(self.max_bytes, int(self.target_bytes*1.25))
+        else:
+            return
+        if target_bytes != self.target_bytes:
+            self.logger.info('SolR update latency %.1f s, request size target changed to %d bytes', elapsed, target_bytes)
+            self.target_bytes = target_bytes
+
+    def reject(self, record, error):
+        """ Write a document rejected by SolR to the dead letter file """
+        self.logger.error('SolR rejected %s, written to dead letter file: %s', record.get('id'), str(error))
+        myline = json.dumps({'id': record.get('id'), 'error': str(error), 'document': record}, default=str)
+        with self.lock:
+            self.norejected += 1
+            self.deadletter.write(myline+'\n')
+            self.deadletter.flush()
+
+    def submit(self, records, done=None):
+        """ Submit records to SolR. Records are sent when enough have been
+            submitted to fill a request, waiting while max_inflight
+            requests are already in flight. Use flush to send the rest.
+
+            Args:
+                records (list): SolR documents
+                done (callable): called as done(records, status) when
+                                 SolR has responded, with status False
+                                 for the records that were not accepted
+        """
+        if self.started is None:
+            self.started = time.monotonic()
+        for record in records:
+            size = document_size(record)
+            if self.pending and (self.pending_bytes + size > self.max_bytes or
+                                 self.pending_bytes >= self.target_bytes):
+                self.dispatch()
+            self.pending.append((record, done))
+            self.pending_bytes += size
+        if self.pending_bytes >= self.target_bytes:
+            self.dispatch()
+
+    def dispatch(self):
+        """ Send the pending records in one request """
+        while len(self.inflight) >= self.max_inflight:
+            self.wait(concurrent.futures.FIRST_COMPLETED)
+        records = [record for record, done in self.pending]
+        future = self.executor.submit(self.send, records)
+        self.inflight[future] = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+
+    def wait(self, return_when=concurrent.futures.ALL_COMPLETED):
+        """ Wait for requests in flight and run their callbacks """
+        finished, _ = concurrent.futures.wait(list(self.inflight), return_when=return_when)
+        for future in finished:
+            pending = self.inflight.pop(future)
+            rejected_ids = set(id(rec) for rec in future.result())
+            if len(rejected_ids) < len(pending):
+                self.logger.info("%d records successfully added to SolR core...", len(pending) - len(rejected_ids))
+            # Report to each callback, in the order submitted
+            results = OrderedDict()
+            for record, done in pending:
+                if done is None:
+                    continue
+                if done not in results:
+                    results[done] = ([], [])
+                results[done][id(record) in rejected_ids].append(record)
+            for done, (accepted, rejected) in results.items():
+                if accepted:
+                    done(accepted, True)
+                if rejected:
+                    done(rejected, False)
+
+    def flush(self):
+        """ Send the pending records and wait for all requests in flight """
+        if self.pending:
+            self.dispatch()
+        while self.inflight:
+            self.wait()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        if self.deadletter is not None:
+            self.deadletter.close()
+
+    def stats(self):
+        """ Counters of the submission as a dictionary """
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started else 0.
+            return {
+                'documents': self.nodocs,
+                'requests': self.norequests,
+                'retries': self.noretries,
+                'failed': self.nofailed,
+                'rejected': self.norejected,
+                'docs_per_second': self.nodocs/elapsed if elapsed > 0 else 0.,
+                'mean_latency': self.latency/self.norequests if self.norequests else 0.,
+                'max_latency': self.maxlatency,
+                'target_bytes': self.target_bytes,
+            }
+
+    def log_stats(self):
+        mystats = self.stats()
+        self.logger.info('SolR updates: %d documents in %d requests (%d retries, %d failed, %d documents rejected), %.1f documents/s, latency mean %.2f s max %.2f s',
+                         mystats['documents'], mystats['requests'], mystats['retries'], mystats['failed'], mystats['rejected'],
+                         mystats['docs_per_second'], mystats['mean_latency'], mystats['max_latency'])
+
+class CapabilitiesCache:
+    """ Cache of WMS GetCapabilities documents by URL. Parsed documents
+    are kept in memory in the current process, and the documents are
+    stored in a SQLite file shared across runs if one is given. Within
+    ttl seconds a cached document is used as is, after that it is
+    revalidated with the server using ETag/If-Modified-Since.
+    """
+
+    # Number of parsed documents kept in memory
+    max_memory = 256
+
+    def __init__(self, dbfile=None, ttl=86400):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.CapabilitiesCache')
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.session = requests.Session()
+        self.db = None
+        if dbfile is not None:
+            self.db = sqlite3.connect(dbfile, timeout=60)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute("""CREATE TABLE IF NOT EXISTS capabilities (
+                url TEXT PRIMARY KEY,
+                fetched REAL,
+                etag TEXT,
+                last_modified TEXT,
+                document BLOB)""")
+            self.db.commit()
+        # Counters
+        self.nohits = 0
+        self.norevalidated = 0
+        self.nofetched = 0
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def load(self, url):
+        """ Read a cached document from the database """
+        if self.db is None:
+            return None
+        row = self.db.execute('SELECT fetched, etag, last_modified, document FROM capabilities WHERE url=?',
+                              (url,)).fetchone()
+        if row is None:
+            return None
+        return {'fetched': row[0], 'etag': row[1], 'last_modified': row[2], 'document': row[3], 'wms': None}
+
+    def save(self, url, entry):
+        """ Write a document to the database """
+        if self.db is None:
+            return
+        self.db.execute('INSERT OR REPLACE INTO capabilities VALUES (?,?,?,?,?)',
+                        (url, entry['fetched'], entry['etag'], entry['last_modified'], entry['document']))
+        self.db.commit()
+
+    def forget(self, url):
+        """ Remove a document from memory and the database """
+        self.memory.pop(url, None)
+        if self.db is not None:
+            self.db.execute('DELETE FROM capabilities WHERE url=?', (url,))
+            self.db.commit()
+
+    def fetch(self, url, entry, timeout):
+        """ Download a document, or revalidate the cached entry """
+        headers = dict()
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        res = self.session.get(WMSCapabilitiesReader().capabilities_url(url), headers=headers, timeout=timeout)
+        if res.status_code == 304 and entry is not None:
+            self.norevalidated += 1
+            entry['fetched'] = time.time()
+            return entry
+        res.raise_for_status()
+        self.nofetched += 1
+        return {'fetched': time.time(), 'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'), 'document': res.content, 'wms': None}
+
+    def get(self, url, timeout=30):
+        """ Get the WMS service described by a GetCapabilities document
+
+            Args:
+                url (str): URL of the WMS service
+                timeout (int): timeout of requests to the service
+            Returns:
+                WebMapService: service with the parsed document
+        """
+        entry = self.memory.get(url)
+        if entry is None:
+            entry = self.load(url)
+        fresh = entry is not None and time.time() - entry['fetched'] < self.ttl
+        if fresh:
+            self.nohits += 1
+        else:
+            entry = self.fetch(url, entry, timeout)
+        if entry['wms'] is None:
+            try:
+                entry['wms'] = WebMapService(url, xml=entry['document'], timeout=timeout)
+            except Exception:
+                # Responses that are not capabilities documents, like
+                # maintenance or exception pages, are not kept
+                self.forget(url)
+                raise
+        if not fresh:
+            self.save(url, entry)
+        self.memory[url] = entry
+        self.memory.move_to_end(url)
+        if len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+        return entry['wms']
+
+    def log_stats(self):
+        self.logger.info('GetCapabilities documents: %d from cache, %d revalidated, %d downloaded',
+                         self.nohits, self.norevalidated, self.nofetched)
+
+class ThumbnailCache:
+    """ Cache of thumbnails in a SQLite file shared across runs, keyed by
+    a hash of everything the thumbnail is created from. Thumbnails older
+    than ttl seconds are created again.
+    """
+
+    def __init__(self, dbfile, ttl=None):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.ThumbnailCache')
+        self.ttl = ttl
+        self.db = sqlite3.connect(dbfile, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS thumbnails (
+            key TEXT PRIMARY KEY,
+            created REAL,
+            thumbnail TEXT)""")
+        self.db.commit()
+        # Counters
+        self.nohits = 0
+        self.nomisses = 0
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def key(*inputs):
+        """ SHA-256 checksum of the inputs of a thumbnail """
+        return hashlib.sha256(repr(inputs).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ Cached thumbnail, None if not cached or expired """
+        row = self.db.execute('SELECT created, thumbnail FROM thumbnails WHERE key=?', (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[0] > self.ttl):
+            self.nomisses += 1
+            return None
+        self.nohits += 1
+        return row[1]
+
+    def put(self, key, thumbnail):
+        self.db.execute('INSERT OR REPLACE INTO thumbnails VALUES (?,?,?)', (key, time.time(), thumbnail))
+        self.db.commit()
+
+    def log_stats(self):
+        self.logger.info('Thumbnails: %d from cache, %d not cached', self.nohits, self.nomisses)
+
+class FeatureTypeCache:
+    """ Cache of the feature types of OPeNDAP datasets in a SQLite file
+    shared across runs, keyed by URL. Datasets without featureType are
+    cached too, as an empty string, and datasets with a featureType that
+    is not valid as None. Feature types older than ttl seconds are read
+    again.
+    """
+
+    def __init__(self, dbfile, ttl=None):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.FeatureTypeCache')
+        self.ttl = ttl
+        self.db = sqlite3.connect(dbfile, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS feature_types (
+            url TEXT PRIMARY KEY,
+            checked REAL,
+            feature_type TEXT)""")
+        self.db.commit()
+        # Counters
+        self.nohits = 0
+        self.nomisses = 0
+
+    def close(self):
+        self.db.close()
+
+    def get(self, url):
+        """ Cached feature type of a dataset
+
+            Args:
+                url (str): OPeNDAP URL
+            Returns:
+                tuple: (found, featureType) where found is False if the
+                       dataset is not cached or expired
+        """
+        row = self.db.execute('SELECT checked, feature_type FROM feature_types WHERE url=?', (url,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[0] > self.ttl):
+            self.nomisses += 1
+            return (False, None)
+        self.nohits += 1
+        return (True, row[1])
+
+    def put(self, url, featureType):
+        self.db.execute('INSERT OR REPLACE INTO feature_types VALUES (?,?,?)', (url, time.time(), featureType))
+        self.db.commit()
+
+    def invalidate(self, prefix=''):
+        """ Remove the datasets with URLs starting with prefix, all if the
+        prefix is empty.
+
+            Args:
+                prefix (str): start of OPeNDAP URLs
+            Returns:
+                int: number of datasets removed
+        """
+        # LIKE ignores case, URLs are compared exactly
+        nodeleted = self.db.execute('DELETE FROM feature_types WHERE substr(url, 1, length(?)) = ?',
+                                    (prefix, prefix)).rowcount
+        self.db.commit()
+        self.logger.info('Removed %d feature types from the cache', nodeleted)
+        return nodeleted
+
+    def log_stats(self):
+        self.logger.info('Feature types: %d from cache, %d not cached', self.nohits, self.nomisses)
+
+class ThumbnailRenderer:
+    """ Render WMS thumbnails in one projection, reusing the figure,
+    axes and coastlines. Coastline geometries are read and projected
+    once, per thumbnail only the WMS image and the extent change. If the
+    WMS layer is offered in a CRS matching the projection, the image is
+    requested from the server in that CRS at the size of the axes and
+    shown as is, otherwise cartopy requests and warps the image.
+    """
+
+    def __init__(self, projection):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.ThumbnailRenderer')
+        self.logger.info('Creating thumbnail renderer for %s', projection)
+        self.projection = projection
+        self.fig = Figure(figsize=(4.5, 4.5), dpi=100)
+        # The Agg canvas provides the renderer used to find the layout
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(projection=projection)
+        # transparent background
+        self.ax.spines['geo'].set_visible(False)
+        self.fig.patch.set_alpha(0)
+        self.fig.set_alpha(0)
+        self.image = None
+        self.coastlines = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.params = projection.to_dict()
+        # WMS CRS codes matching the projection
+        self.native = dict()
+
+    def find_native_crs(self, crs_options):
+        """ Find a CRS offered by a WMS layer that is the projection of the
+        renderer, apart from scale, false easting/northing and ellipsoid.
+        Images in such a CRS need no warping, e.g. EPSG:4326 for
+        PlateCarree, EPSG:3395 or EPSG:3857 for Mercator and EPSG:3995 or
+        EPSG:32661 for the north polar stereographic projection.
+
+            Args:
+                crs_options (list): CRS codes offered by the layer
+            Returns:
+                str: CRS code, None if none matches
+        """
+        for code in crs_options:
+            if code not in self.native:
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        params = pyproj.CRS.from_user_input(code.replace('CRS:84', 'OGC:CRS84')).to_dict()
+                except Exception:
+                    params = dict()
+                self.native[code] = (params.get('proj') == self.params.get('proj') and
+                                     params.get('lon_0', 0) == self.params.get('lon_0', 0) and
+                                     params.get('lat_0', 0) == self.params.get('lat_0', 0))
+            if self.native[code]:
+                return code
+        return None
+
+    def add_getmap(self, wms, wms_layer, wms_style, crs, timeout):
+        """ Show the WMS image of the extent of the axes, requested in a
+        native CRS at the size of the axes
+        """
+        self.fig.draw(self.fig.canvas.get_renderer())
+        x0, x1, y0, y1 = self.ax.get_extent()
+        window = self.ax.get_window_extent()
+        transformer = pyproj.Transformer.from_crs(self.projection, crs.replace('CRS:84', 'OGC:CRS84'),
+                                                  always_xy=True)
+        xx, yy = transformer.transform([x0, x1, x0, x1], [y0, y0, y1, y1])
+        res = wms.getmap(layers=[wms_layer], styles=wms_style, srs=crs,
+                         bbox=(min(xx), min(yy), max(xx), max(yy)),
+                         size=(max(1, round(window.width)), max(1, round(window.height))),
+                         format='image/png', transparent=False, timeout=timeout)
+        with PIL.Image.open(io.BytesIO(res.read())) as img:
+            data = numpy.asarray(img.convert('RGBA'))
+        with self.ax.hold_limits():
+            return self.ax.imshow(data, extent=(x0, x1, y0, y1), transform=self.projection,
+                                  origin='upper')
+
+    def prepare(self, extent, add_coastlines):
+        """ Remove the image of the last thumbnail and set the extent """
+        if self.image is not None:
+            self.image.remove()
+            self.image = None
+
+        if add_coastlines and self.coastlines is None:
+            self.coastlines = self.ax.coastlines(resolution="50m",linewidth=0.5)
+        if self.coastlines is not None:
+            self.coastlines.set_visible(bool(add_coastlines))
+        if self.projection == ccrs.PlateCarree():
+            self.ax.set_extent(extent)
+        else:
+            self.ax.set_extent(extent, ccrs.PlateCarree())
+
+    def save(self):
+        """ Render the figure to PNG """
+        # Find the tight layout without the image, bbox_inches='tight'
+        # would draw the figure twice and fetch a WMS image twice
+        if self.image is not None:
+            self.image.set_visible(False)
+        renderer = self.fig.canvas.get_renderer()
+        self.fig.draw(renderer)
+        bbox = self.fig.get_tightbbox(renderer).padded(plt.rcParams['savefig.pad_inches'])
+        if self.image is not None:
+            self.image.set_visible(True)
+
+        # Render into memory
+        thumbnail_buffer = io.BytesIO()
+        self.fig.savefig(thumbnail_buffer, format='png', bbox_inches=bbox)
+        return thumbnail_buffer
+
+    def render_grid(self, lon, lat, data, extent, add_coastlines):
+        """ Render gridded data to PNG
+
+            Args:
+                lon (array): longitudes, 1D or 2D
+                lat (array): latitudes, 1D or 2D
+                data (array): 2D data values
+                extent (list): extent in lat/lon [x0, x1, y0, y1]
+                add_coastlines (bool): If coastlines should be added
+            Returns:
+                BytesIO: PNG image
+        """
+        self.prepare(extent, add_coastlines)
+        with self.ax.hold_limits():
+            self.image = self.ax.pcolormesh(lon, lat, data, transform=ccrs.PlateCarree(),
+                                            shading='auto')
+        return self.save()
+
+    def render(self, wms, wms_layer, wms_style, extent, add_coastlines, native_crs=None, timeout=None):
+        """ Render a WMS layer to PNG
+
+            Args:
+                wms (WebMapService): WMS service
+                wms_layer (str): WMS layer name
+                wms_style (list): WMS style names, or None
+                extent (list): extent in lat/lon [x0, x1, y0, y1]
+                add_coastlines (bool): If coastlines should be added
+                native_crs (str): CRS of the layer matching the projection
+                timeout (int): timeout of the GetMap request in a native
+                               CRS
+            Returns:
+                BytesIO: PNG image
+        """
+        self.prepare(extent, add_coastlines)
+
+        if native_crs is not None:
+            try:
+                self.image = self.add_getmap(wms, wms_layer, wms_style, native_crs, timeout)
+            except Exception as e:
+                self.logger.warning('Could not get WMS image in %s, warping instead: %s', native_crs, e)
+        if self.image is None:
+            try:
+                self.image = self.ax.add_wms(wms, wms_layer,
+                    wms_kwargs={'transparent': False,
+                        'styles':wms_style})
+            except Exception as e:
+                self.logger.error('Could not set up WMS plotting: %s', e)
+
+        return self.save()
+
+def is_host_failure(error):
+    """ Check if an error of a remote call means that the server is
+        unreachable or failing, rather than that the request can't be
+        served.
+
+        Args:
+            error (Exception): error raised by the remote call
+        Returns:
+            bool: True if the host failed
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, urllib.error.URLError,
+                          TimeoutError, ConnectionError)):
+        return True
+    # netCDF4 reports OPeNDAP servers that can't be reached as I/O failure,
+    # and server errors (HTTP 5xx) as DAP server error
+    if isinstance(error, OSError) and error.errno in (-68, -70):
+        return True
+    return False
+
+# Tokens of a DAP2 DAS response: quoted strings, braces, separators and words
+DAS_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|[{};,]|[^\s{};,"]+')
+
+def das_global_attribute(das, name):
+    """ Find a global attribute in a DAP2 DAS response. Global attributes
+        are in containers named NC_GLOBAL, or GLOBAL or ending with
+        _GLOBAL on some servers.
+
+        Args:
+            das (str): DAS response
+            name (str): attribute name
+        Returns:
+            str: first value of the attribute, None if not found
+        Raises:
+            ValueError: if das is not a DAS response
+    """
+    tokens = DAS_TOKENS.findall(das)
+    if len(tokens) < 2 or tokens[0] != 'Attributes' or tokens[1] != '{':
+        raise ValueError('Not a DAS response')
+    containers = []
+    statement = []
+    for token in tokens[2:]:
+        if token == '{':
+            containers.append(statement[-1] if statement else '')
+            statement = []
+        elif token == '}':
+            if not containers:
+                break
+            containers.pop()
+            statement = []
+        elif token == ';':
+            # Statements are: type name value [, value ...]
+            if (len(containers) == 1 and len(statement) > 2 and statement[1] == name and
+                    (containers[0].upper() == 'GLOBAL' or containers[0].upper().endswith('_GLOBAL'))):
+                value = statement[2]
+                if value.startswith('"'):
+                    value = re.sub(r'\\(.)', r'\1', value[1:-1])
+                return value
+            statement = []
+        elif token != ',':
+            statement.append(token)
+    return None
+
+class HostCircuitBreaker:
+    """ Track failures of remote calls per host. After threshold
+    consecutive failures the circuit of the host is opened, and calls to
+    it are skipped for cooldown seconds. Then one call is let through,
+    closing the circuit if the host responds and opening it again if
+    not. Skipped calls are reported in one line per host by log_stats.
+    """
+
+    def __init__(self, threshold=3, cooldown=600):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.HostCircuitBreaker')
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        # Consecutive failures and time the circuit was opened by host
+        self.failures = dict()
+        self.opened = dict()
+        # Hosts with a call let through after the cooldown
+        self.trial = set()
+        # Number of calls skipped by host
+        self.skipped = dict()
+
+    @staticmethod
+    def host(url):
+        return urllib.parse.urlsplit(url).netloc
+
+    def is_open(self, url):
+        with self.lock:
+            return self.host(url) in self.opened
+
+    def allow(self, url):
+        """ Check if a call to the host of url should be made
+
+            Args:
+                url (str): URL to call
+            Returns:
+                bool: False if the call should be skipped
+        """
+        host = self.host(url)
+        with self.lock:
+            if host not in self.opened:
+                return True
+            if host not in self.trial and time.monotonic() - self.opened[host] >= self.cooldown:
+                self.trial.add(host)
+                return True
+            self.skipped[host] = self.skipped.get(host, 0) + 1
+            return False
+
+    def record(self, url, failed):
+        """ Record the outcome of a call that was allowed
+
+            Args:
+                url (str): URL called
+                failed (bool): True if the host failed, see
+                               is_host_failure
+        """
+        host = self.host(url)
+        with self.lock:
+            if not failed:
+                self.failures.pop(host, None)
+                if host in self.opened:
+                    self.logger.info('Host %s responds again', host)
+                    del self.opened[host]
+                    self.trial.discard(host)
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if host in self.trial:
+                self.opened[host] = time.monotonic()
+                self.trial.discard(host)
+            elif host not in self.opened and self.failures[host] >= self.threshold:
+                self.logger.warning('Host %s failed %d times in a row, skipping calls to it for %d s',
+                                    host, self.failures[host], self.cooldown)
+                self.opened[host] = time.monotonic()
+
+    def log_stats(self):
+        for host, noskipped in sorted(self.skipped.items()):
+            self.logger.warning('Skipped %d calls to %s, the host failed', noskipped, host)
+
+class HostScheduler:
+    """ Limit the number of concurrent calls to each remote host, so
+    that a single THREDDS server is not flooded by the workers. Tasks are
+    interleaved across hosts, so workers waiting for a busy host are given
+    tasks for other hosts. The dispatcher of the worker pool takes a slot
+    with try_acquire and gives it back with release.
+    """
+
+    def __init__(self, limit=None, limits=None):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.HostScheduler')
+        # Default limit, and limits by host name or host:port
+        self.limit = limit
+        self.limits = limits or dict()
+        # Number of calls running by host, and the most calls running at a
+        # time by host
+        self.running = dict()
+        self.peak = dict()
+
+    @staticmethod
+    def host(url):
+        return urllib.parse.urlsplit(url).netloc
+
+    def host_limit(self, host):
+        if host in self.limits:
+            return self.limits[host]
+        return self.limits.get(host.split(':')[0], self.limit)
+
+    def interleave(self, urls):
+        """ Order calls to take one from each host in turn, keeping the
+        order of the calls to each host.
+
+            Args:
+                urls (list): URLs called
+            Returns:
+                list: indices of urls in the order to call them
+        """
+        byhost = OrderedDict()
+        for i, url in enumerate(urls):
+            byhost.setdefault(self.host(url), deque()).append(i)
+        order = []
+        while byhost:
+            for host in list(byhost):
+                order.append(byhost[host].popleft())
+                if not byhost[host]:
+                    del byhost[host]
+        return order
+
+    def try_acquire(self, url):
+        """ Take a slot for a call to the host of url if one is free
+
+            Args:
+                url (str): URL called
+            Returns:
+                bool: True if the call can be made, release must be
+                      called when it is done
+        """
+        host = self.host(url)
+        limit = self.host_limit(host)
+        running = self.running.get(host, 0)
+        if limit is not None and running >= limit:
+            return False
+        self.running[host] = running + 1
+        self.peak[host] = max(self.peak.get(host, 0), running + 1)
+        return True
+
+    def release(self, url):
+        host = self.host(url)
+        self.running[host] -= 1
+        if self.running[host] == 0:
+            del self.running[host]
+
+    def log_stats(self):
+        for host, peak in sorted(self.peak.items()):
+            self.logger.info('At most %d concurrent calls to %s', peak, host)
+
+class TaskPool:
+    """ Run tasks in a pool of worker processes with a timeout per task.
+    Tasks are handed to the workers only when a worker is free, thus the
+    time a task has been handed over is the time it has been running. A
+    worker can't be interrupted, so when a task times out the workers are
+    terminated and a new pool is started, and the other tasks that were
+    running are run again. Logging in the workers is routed to the
+    handlers of the indexdata logger.
+    """
+
+    def __init__(self, workers, timeout=None, initializer=None, initargs=()):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.TaskPool')
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+        self.listener = None
+        self.notimeouts = 0
+
+    def start(self):
+        mylog = logging.getLogger('indexdata')
+        if self.listener is None:
+            self.logqueue = multiprocessing.Queue()
+            self.listener = QueueListener(self.logqueue, *mylog.handlers, respect_handler_level=True)
+            self.listener.start()
+        self.pool = multiprocessing.Pool(self.workers, initializer=init_task_worker,
+                                         initargs=(self.logqueue, self.initializer, self.initargs))
+
+    def restart(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.start()
+
+    def run(self, func, tasks, labels=None, breaker=None, scheduler=None):
+        """ Run func on each task in the worker processes. With a circuit
+        breaker or a scheduler the labels are the URLs called by the tasks.
+        Tasks calling hosts that failed are skipped, and func must return
+        a (result, host_failed) tuple. The scheduler limits the tasks
+        running for each host, and interleaves the tasks across hosts.
+
+            Args:
+                func (callable): module level function taking one task
+                tasks (list): arguments of func, must be picklable
+                labels (list): description of each task used in logging
+                breaker (HostCircuitBreaker): failures by host
+                scheduler (HostScheduler): concurrent calls by host
+            Returns:
+                list: results in the order of the tasks, None for tasks
+                      that failed, timed out or were skipped
+        """
+        if self.pool is None:
+            self.start()
+        if labels is None:
+            labels = [str(task) for task in tasks]
+        results = [None]*len(tasks)
+        if scheduler is None:
+            waiting = deque(range(len(tasks)))
+        else:
+            waiting = deque(scheduler.interleave(labels))
+        running = dict()
+        allowed = set()
+        while waiting or running:
+            while waiting and len(running) < self.workers:
+                i = self.next_task(waiting, labels, scheduler)
+                if i is None:
+                    # All hosts with tasks waiting are busy
+                    break
+                if breaker is not None and i not in allowed:
+                    if not breaker.allow(labels[i]):
+                        if scheduler is not None:
+                            scheduler.release(labels[i])
+                        continue
+                    allowed.add(i)
+                running[i] = (self.pool.apply_async(func, (tasks[i],)), time.monotonic())
+            expired = False
+            now = time.monotonic()
+            for i, (result, started) in list(running.items()):
+                if result.ready():
+                    del running[i]
+                    if scheduler is not None:
+                        scheduler.release(labels[i])
+                    host_failed = False
+                    try:
+                        results[i] = result.get()
+                    except Exception as e:
+                        self.logger.warning('Task %s failed: %s', labels[i], e)
+                    if breaker is not None:
+                        if results[i] is not None:
+                            results[i], host_failed = results[i]
+                        breaker.record(labels[i], host_failed)
+                elif self.timeout is not None and now - started > self.timeout:
+                    del running[i]
+                    if scheduler is not None:
+                        scheduler.release(labels[i])
+                    self.notimeouts += 1
+                    self.logger.warning('Task %s timed out after %d s', labels[i], self.timeout)
+                    if breaker is not None:
+                        breaker.record(labels[i], True)
+                    expired = True
+            if expired:
+                # Run the tasks that were interrupted again in a new pool
+                self.logger.info('Restarting worker processes')
+                self.restart()
+                if scheduler is not None:
+                    for i in running:
+                        scheduler.release(labels[i])
+                waiting.extendleft(sorted(running, reverse=True))
+                running = dict()
+            elif running:
+                sleep(0.05)
+        return results
+
+    @staticmethod
+    def next_task(waiting, labels, scheduler):
+        """ Take the first waiting task whose host has a free slot """
+        if scheduler is None:
+            return waiting.popleft()
+        for n, i in enumerate(waiting):
+            if scheduler.try_acquire(labels[i]):
+                del waiting[n]
+                return i
+        return None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
 class IndexMMD:
     """ Class for indexing SolR representation of MMD to SolR server. Requires
     a list of dictionaries representing MMD as input.
     """
 
-    def __init__(self, mysolrserver, always_commit=False, authentication=None, no_feature=False):
+    def __init__(self, mysolrserver, always_commit=False, authentication=None, no_feature=False, *,
+                 max_inflight=1, retries=3, backoff=2.0, deadletter=None,
+                 target_bytes=8*1024*1024, max_bytes=32*1024*1024, target_latency=None,
+                 thumbnail_workers=0, thumbnail_timeout=None,
+                 capabilities_cache=None, capabilities_ttl=86400,
+                 thumbnail_cache=None, thumbnail_cache_ttl=None, direct_getmap=True,
+                 host_failures=3, host_cooldown=600, host_concurrency=4,
+                 host_concurrency_by_host=None, feature_workers=0, opendap_timeout=None,
+                 feature_type_vote='first', feature_type_cache=None, feature_type_cache_ttl=None,
+                 local_paths=None, grid_thumbnails=True):
+        """ Without mysolrserver no SolR client is created, this is used
+        in worker processes creating thumbnails and reading feature types.
+        The settings following no_feature are passed by keyword.
+        """
         # Set up logging
         self.logger = logging.getLogger('indexdata.IndexMMD')
         self.logger.info('Creating an instance of IndexMMD')
@@ -1192,13 +2283,80 @@ class IndexMMD:
         self.projection = None
         self.thumbnail_type = None
         self.thumbnail_extent = None
-
-        # Feature extraction
+        # Quicklooks of gridded OPeNDAP datasets without WMS
+        self.grid_thumbnails = grid_thumbnails
+        # WMS GetCapabilities documents, cached on disk if a file is given
+        self.capabilities_cache = CapabilitiesCache(capabilities_cache, capabilities_ttl)
+        # Thumbnail renderers by projection, and if WMS images should be
+        # requested in the projection when the server offers it
+        self.renderers = dict()
+        self.direct_getmap = direct_getmap
+        # Thumbnails created before with the same settings
+        self.thumbnail_cache = None
+        if thumbnail_cache is not None:
+            self.thumbnail_cache = ThumbnailCache(thumbnail_cache, thumbnail_cache_ttl)
+        # Thumbnails are created in a pool of processes if workers are
+        # given, matplotlib is not thread safe. The workers have their
+        # own instance with the same caches.
+        worker_args = {
+            'capabilities_cache': capabilities_cache,
+            'capabilities_ttl': capabilities_ttl,
+            'thumbnail_cache': thumbnail_cache,
+            'thumbnail_cache_ttl': thumbnail_cache_ttl,
+            'direct_getmap': direct_getmap,
+            'opendap_timeout': opendap_timeout,
+            'feature_type_cache': feature_type_cache,
+            'feature_type_cache_ttl': feature_type_cache_ttl,
+            'local_paths': local_paths,
+        }
+        self.thumbnail_pool = None
+        if thumbnail_workers > 0:
+            self.thumbnail_pool = TaskPool(thumbnail_workers, thumbnail_timeout,
+                                           init_indexer_worker, (worker_args,))
+
+        # Feature extraction, OPeNDAP datasets are opened in a pool of
+        # processes if workers are given, netCDF is not thread safe.
+        # Records with several OPeNDAP URLs get the feature type of the
+        # first URL having one, or of most URLs with 'majority'.
         self.no_feature = no_feature
+        self.feature_type_vote = feature_type_vote
+        # featureType is read from the DAS of the datasets, and the
+        # datasets are opened with netCDF4 only if that fails
+        self.opendap_timeout = opendap_timeout
+        self.opendap_session = requests.Session()
+        # Each request of netCDF4 to an OPeNDAP server is given the same
+        # time, also when datasets are read without worker processes
+        if opendap_timeout is not None:
+            if hasattr(netCDF4, 'rc_set'):
+                netCDF4.rc_set('HTTP.TIMEOUT', str(max(1, math.ceil(opendap_timeout))))
+                netCDF4.rc_set('HTTP.CONNECTTIMEOUT', str(max(1, math.ceil(opendap_timeout))))
+            else:
+                self.logger.warning('netCDF4 %s can not limit the time of OPeNDAP requests',
+                                    netCDF4.__version__)
+        # Local directories of OPeNDAP URL prefixes, datasets found there
+        # are read from disk. Longer prefixes are tried first.
+        self.local_paths = local_paths or dict()
+        self.local_prefixes = sorted(self.local_paths, key=len, reverse=True)
+        # Feature types read before, by URL
+        self.feature_type_cache = None
+        if feature_type_cache is not None:
+            self.feature_type_cache = FeatureTypeCache(feature_type_cache, feature_type_cache_ttl)
+        self.feature_pool = None
+        if feature_workers > 0 and not no_feature:
+            self.feature_pool = TaskPool(feature_workers, opendap_timeout,
+                                         init_indexer_worker, (worker_args,))
+
+        # Calls to WMS and OPeNDAP hosts that keep failing are skipped
+        self.host_breaker = HostCircuitBreaker(host_failures, host_cooldown)
+        # Concurrent calls to WMS and OPeNDAP hosts
+        self.host_scheduler = HostScheduler(host_concurrency, host_concurrency_by_host)
+        self.remote_error = None
 
         # Create a client instance
         self.authentication = authentication
         self.mysolrserver = mysolrserver
+        if mysolrserver is None:
+            return
         self.logger.info('Creating SolR client')
         try:
             self.solrc = pysolr.Solr(mysolrserver, always_commit=always_commit, timeout=1020, auth=authentication)
@@ -1213,17 +2371,52 @@ class IndexMMD:
         except Exception as e:
             self.logger.error('Could not reach the SolR server: %s', e)
             raise SystemExit()
+        # Pooled connections for lookups, shared with the SolR client
+        self.session = self.solrc.get_session()
+        # Submission of updates
+        self.submitter = SolrSubmitter(self.solrc, max_inflight, retries, backoff, deadletter,
+                                       target_bytes, max_bytes, target_latency)
+        # Parents are flagged in the index by atomic updates
+        self.parent_updater = SolrSubmitter(self.solrc, max_inflight, retries, backoff,
+                                            field_updates={'isParent': 'set'})
 
     #Function for sending explicit commit to solr
     def commit(self):
+        self.submitter.flush()
         self.solrc.commit()
 
+    def flush(self):
+        """ Wait for all updates submitted to SolR and report counters """
+        self.submitter.flush()
+        self.submitter.log_stats()
+
+    def close(self):
+        """ Send the updates waiting, stop worker processes and close
+        caches. Parents must have been reconciled.
+        """
+        self.submitter.close()
+        self.parent_updater.close()
+        if self.thumbnail_pool is not None:
+            self.thumbnail_pool.close()
+        if self.feature_pool is not None:
+            self.feature_pool.close()
+        self.host_breaker.log_stats()
+        self.host_scheduler.log_stats()
+        self.capabilities_cache.log_stats()
+        self.capabilities_cache.close()
+        if self.feature_type_cache is not None:
+            self.feature_type_cache.log_stats()
+            self.feature_type_cache.close()
+        if self.thumbnail_cache is not None:
+            self.thumbnail_cache.log_stats()
+            self.thumbnail_cache.close()
+
     """
     Primary function to index records, rewritten to expect list input
     """
     def index_record(self, records2ingest, addThumbnail, wms_layer=None, wms_style=None, 
                      wms_zoom_level=0, add_coastlines=True, projection=ccrs.PlateCarree(), wms_timeout=120, 
-                     thumbnail_extent=None,predefined_thumbnail_path=None):
+                     thumbnail_extent=None,predefined_thumbnail_path=None, done=None):
         # FIXME, update the text below Øystein Godøy, METNO/FOU, 2023-03-19
         """ Add thumbnail to SolR
             Args:
@@ -1239,12 +2432,24 @@ class IndexMMD:
                 thumbnail_extent (list): Spatial extent of the thumbnail in
                                       lat/lon [x0, x1, y0, y1]
                 predefined_thumbnail (str): absolute filepath to thumbnail picture. Default value: None
+                done (callable): If given the records are submitted
+                                 without waiting for SolR, done(records,
+                                 status) is called when SolR has responded
             Returns:
                 bool
         """
 
         mmd_records = list()
+        thumbnails = list()
+        features = list()
         norec = len(records2ingest)
+        self.wms_layer = wms_layer
+        self.wms_style = wms_style
+        self.wms_zoom_level = wms_zoom_level
+        self.add_coastlines = add_coastlines
+        self.projection = projection
+        self.wms_timeout = wms_timeout
+        self.thumbnail_extent = thumbnail_extent
         i = 1
         for input_record in records2ingest:
             self.logger.info("====>")
@@ -1260,52 +2465,49 @@ class IndexMMD:
             If OGC WMS is available, no point in looking for featureType in OPeNDAP.
             """
             if predefined_thumbnail_path and addThumbnail:
-                thumbnail_data = self.add_thumbnail(url=predefined_thumbnail_path,thumbnail_type='fpath')
+                thumbnails.append((input_record, predefined_thumbnail_path, 'fpath'))
 
             elif 'data_access_url_ogc_wms' in input_record and addThumbnail:
                 self.logger.info("Checking thumbnails...")
                 getCapUrl = input_record['data_access_url_ogc_wms']
+                # The SolR document holds a list of WMS URLs
+                if isinstance(getCapUrl, list):
+                    getCapUrl = getCapUrl[0]
                 if not myfeature:
                     self.thumbnail_type = 'wms'
-                self.wms_layer = wms_layer
-                self.wms_style = wms_style
-                self.wms_zoom_level = wms_zoom_level
-                self.add_coastlines = add_coastlines
-                self.projection = projection
-                self.wms_timeout = wms_timeout
-                self.thumbnail_extent = thumbnail_extent
-                thumbnail_data = self.add_thumbnail(url=getCapUrl, thumbnail_type=self.thumbnail_type)
-
-                if not thumbnail_data:
-                    self.logger.warning('Could not properly parse WMS GetCapabilities document')
-                    # If WMS is not available, remove this data_access element from the XML that is indexed
-                    del input_record['data_access_url_ogc_wms']
-                else:
-                    input_record.update({'thumbnail_data':thumbnail_data})
+                thumbnails.append((input_record, getCapUrl, self.thumbnail_type))
             elif (not self.no_feature) and 'data_access_url_opendap' in input_record:
                 # Thumbnail of timeseries to be added
                 # Or better do this as part of get_feature_type?
-                try:
-                    myfeature = self.get_feature_type(input_record['data_access_url_opendap'])
-                except Exception as e:
-                    self.logger.warning("Something failed while retrieving feature type: %s", str(e))
-                if myfeature:
-                    self.logger.info('feature_type found: %s', myfeature)
-                    input_record.update({'feature_type':myfeature})
+                features.append(input_record)
             else:
                 self.logger.info('Neither gridded nor discrete sampling geometry found in this record...')
 
             self.logger.info("Adding records to list...")
             mmd_records.append(input_record)
 
+        # Time series, trajectories and profiles get a sparkline thumbnail,
+        # datasets read without feature type a quicklook of the grid
+        for input_record, myopendap, myfeature in self.add_feature_types(features):
+            if not addThumbnail:
+                continue
+            if myfeature in TS_FEATURE_TYPES:
+                thumbnails.append((input_record, myopendap, 'ts'))
+            elif myfeature == '' and self.grid_thumbnails:
+                thumbnails.append((input_record, myopendap, 'grid'))
+        self.add_thumbnails(thumbnails)
+
         """
         Send information to SolR
         """
         self.logger.info("Adding records to SolR core.")
-        try:
-            self.solrc.add(mmd_records)
-        except Exception as e:
-            self.logger.error("Something failed in SolR adding document: %s", str(e))
+        if done is not None:
+            self.submitter.submit(mmd_records, done)
+            return True
+        status = []
+        self.submitter.submit(mmd_records, lambda records, accepted: status.append(accepted))
+        self.submitter.flush()
+        if not all(status):
             return False
         self.logger.info("%d records successfully added to SolR core...", len(mmd_records))
 
@@ -1313,20 +2515,204 @@ class IndexMMD:
 
         return True
 
+    def add_feature_types(self, records):
+        """ Find the feature type of records from the featureType attribute
+        of their OPeNDAP datasets, and add it to the records. With a pool of
+        feature workers the datasets of a batch are opened concurrently,
+        each within the OPeNDAP timeout. Records with several OPeNDAP URLs
+        get the feature type of the first URL that has one, or with
+        feature_type_vote 'majority' the one found for most URLs.
+
+            Args:
+                records (list): records with data_access_url_opendap
+            Returns:
+                list: (record, url, featureType) of the records, where
+                      featureType is '' if the datasets read have no
+                      featureType and None if none could be read or the
+                      featureType is not valid. url is the first OPeNDAP
+                      URL having the feature type found, or the first URL
+                      read without featureType.
+        """
+        if len(records) == 0:
+            return []
+        urls = list()
+        for input_record in records:
+            myopendap = input_record['data_access_url_opendap']
+            urls.append([myopendap] if isinstance(myopendap, str) else list(myopendap))
+        # Feature types found by URL of each record, '' if the dataset
+        # has none and None on failure
+        found = [dict() for input_record in records]
+        majority = self.feature_type_vote == 'majority'
+        pending = list(range(len(records)))
+        k = 0
+        while pending:
+            # All URLs are opened at once for a vote, else the next URL
+            # of records without a feature type
+            if majority:
+                probes = [(i, url) for i in pending for url in urls[i]]
+            else:
+                probes = [(i, urls[i][k]) for i in pending if k < len(urls[i])]
+            if not probes:
+                break
+            self.logger.info('Opening %d OPeNDAP datasets to find feature types', len(probes))
+            results = self.probe_feature_types([url for i, url in probes])
+            for (i, url), featureType in zip(probes, results):
+                found[i][url] = featureType
+            if majority:
+                break
+            pending = [i for i in pending if not found[i].get(urls[i][k])]
+            k += 1
+
+        probed = []
+        for input_record, recordurls, recordfound in zip(records, urls, found):
+            self.id = input_record['id']
+            myfeature = self.choose_feature_type(recordurls, recordfound)
+            if myfeature:
+                self.logger.info('feature_type found: %s', myfeature)
+                input_record.update({'feature_type':myfeature})
+                probed.append((input_record, [url for url in recordurls if recordfound.get(url) == myfeature][0],
+                               myfeature))
+            elif '' in recordfound.values():
+                # Read, but without featureType
+                probed.append((input_record, [url for url in recordurls if recordfound.get(url) == ''][0], ''))
+            else:
+                probed.append((input_record, recordurls[0], None))
+        return probed
+
+    def probe_feature_types(self, urls):
+        """ Read the feature types of OPeNDAP datasets, skipping hosts that
+        failed.
+
+            Args:
+                urls (list): OPeNDAP URLs
+            Returns:
+                list: feature types in the order of urls, '' for datasets
+                      without featureType, None on failure
+        """
+        # Only datasets not found in the cache are read
+        results = [None]*len(urls)
+        missing = list(range(len(urls)))
+        if self.feature_type_cache is not None:
+            missing = []
+            for i, url in enumerate(urls):
+                found, results[i] = self.feature_type_cache.get(url)
+                if not found:
+                    missing.append(i)
+        if self.feature_pool is not None:
+            if missing:
+                read = self.feature_pool.run(feature_type_task, [urls[i] for i in missing],
+                                             [urls[i] for i in missing],
+                                             self.host_breaker, self.host_scheduler)
+                for i, featureType in zip(missing, read):
+                    results[i] = featureType
+            return results
+        for i in missing:
+            url = urls[i]
+            if self.host_breaker.allow(url):
+                try:
+                    results[i] = self.get_feature_type([url])
+                    self.host_breaker.record(url, False)
+                except Exception as e:
+                    self.logger.warning("Something failed while retrieving feature type: %s", str(e))
+                    self.host_breaker.record(url, is_host_failure(e))
+        return results
+
+    def choose_feature_type(self, urls, found):
+        """ Choose the feature type of a record with one or more OPeNDAP URLs
+
+            Args:
+                urls (list): OPeNDAP URLs of the record
+                found (dict): feature types found by URL, '' if none and
+                              None on failure
+            Returns:
+                str: feature type, None if not found
+        """
+        featureTypes = [found[url] for url in urls if found.get(url)]
+        if not featureTypes:
+            return None
+        if len(set(featureTypes)) > 1:
+            self.logger.warning('OPeNDAP URLs of %s disagree on feature type: %s',
+                                self.id, ', '.join(featureTypes))
+        if self.feature_type_vote == 'majority':
+            # Ties are won by the feature type of the first URL
+            votes = Counter(featureTypes)
+            return max(featureTypes, key=lambda featureType: votes[featureType])
+        return featureTypes[0]
+
+    def add_thumbnails(self, thumbnails):
+        """ Create thumbnails and add them to the records. With a pool of
+        thumbnail workers these are created concurrently, each within the
+        thumbnail timeout.
+
+            Args:
+                thumbnails (list): (record, url, thumbnail_type) tuples
+        """
+        if len(thumbnails) == 0:
+            return
+        # Only thumbnails not found in the cache are created
+        results = [self.cached_thumbnail(url, thumbnail_type) if thumbnail_type != 'fpath' else None
+                   for input_record, url, thumbnail_type in thumbnails]
+        missing = [i for i, thumbnail_data in enumerate(results) if thumbnail_data is None]
+        if self.thumbnail_pool is None:
+            for i in missing:
+                input_record, url, thumbnail_type = thumbnails[i]
+                if thumbnail_type == 'fpath':
+                    results[i] = self.add_thumbnail(url=url, thumbnail_type=thumbnail_type)
+                elif self.host_breaker.allow(url):
+                    self.id = input_record['id']
+                    results[i] = self.add_thumbnail(url=url, thumbnail_type=thumbnail_type)
+                    self.host_breaker.record(url, is_host_failure(self.remote_error))
+        else:
+            self.logger.info('Creating %d thumbnails using %d worker processes',
+                             len(missing), self.thumbnail_pool.workers)
+            settings = {
+                'wms_layer': self.wms_layer,
+                'wms_style': self.wms_style,
+                'wms_zoom_level': self.wms_zoom_level,
+                'wms_timeout': self.wms_timeout,
+                'add_coastlines': self.add_coastlines,
+                'projection': self.projection,
+                'thumbnail_extent': self.thumbnail_extent,
+            }
+            tasks = [(thumbnails[i][1], thumbnails[i][2], dict(settings, id=thumbnails[i][0]['id']))
+                     for i in missing]
+            created = self.thumbnail_pool.run(create_thumbnail_task, tasks,
+                                              [thumbnails[i][1] for i in missing],
+                                              self.host_breaker, self.host_scheduler)
+            for i, thumbnail_data in zip(missing, created):
+                results[i] = thumbnail_data
+
+        for (input_record, url, thumbnail_type), thumbnail_data in zip(thumbnails, results):
+            if thumbnail_data:
+                input_record.update({'thumbnail_data':thumbnail_data})
+            elif thumbnail_type == 'wms':
+                # Hosts that failed are reported by the circuit breaker
+                if not self.host_breaker.is_open(url):
+                    self.logger.warning('Could not properly parse WMS GetCapabilities document')
+                # If WMS is not available, remove this data_access element from the XML that is indexed
+                del input_record['data_access_url_ogc_wms']
+
     def add_thumbnail(self, url, thumbnail_type='wms'):
         """ Add thumbnail to SolR
             Args:
-                url / file: url to getcapabilities document for WMS / file to pregenerated thumbnail (JPEG, PNG, ...)
-                type: Thumbnail type. (wms, ts)
+                url / file: url to getcapabilities document for WMS / file to pregenerated thumbnail (JPEG, PNG, ...) / OPeNDAP url
+                type: Thumbnail type. (wms, fpath, ts, grid)
             Returns:
                 thumbnail: base64 string representation of image
         """
         self.logger.info('Processing %s',url)
+        self.remote_error = None
         if thumbnail_type == 'wms':
+            thumbnail = self.cached_thumbnail(url)
+            if thumbnail is not None:
+                return thumbnail
             try:
                 thumbnail = self.create_wms_thumbnail(url)
+                if self.thumbnail_cache is not None:
+                    self.thumbnail_cache.put(self.thumbnail_key(url), thumbnail)
                 return thumbnail
             except Exception as e:
+                self.remote_error = e
                 self.logger.error("Thumbnail creation from OGC WMS failed: %s",e)
 
         if thumbnail_type == 'fpath':
@@ -1337,14 +2723,47 @@ class IndexMMD:
                 self.logger.error("Thumbnail creation from OGC WMS failed: %s",e)
                 return None
             
-        elif thumbnail_type == 'ts': #time_series
-            thumbnail = 'TMP'  # create_ts_thumbnail(...)
-            return thumbnail
+        elif thumbnail_type in ('ts', 'grid'): #time_series or gridded
+            thumbnail = self.cached_thumbnail(url, thumbnail_type)
+            if thumbnail is not None:
+                return thumbnail
+            try:
+                if thumbnail_type == 'ts':
+                    thumbnail = self.create_ts_thumbnail(url)
+                else:
+                    thumbnail = self.create_grid_thumbnail(url)
+                if self.thumbnail_cache is not None:
+                    self.thumbnail_cache.put(self.thumbnail_key(url, thumbnail_type), thumbnail)
+                return thumbnail
+            except Exception as e:
+                self.remote_error = e
+                self.logger.error("Thumbnail creation from OPeNDAP failed: %s",e)
+                return None
         else:
             self.logger.error('Invalid thumbnail type: {}'.format(thumbnail_type))
             return None
 
 
+    def thumbnail_key(self, url, thumbnail_type='wms'):
+        """ Key of a thumbnail in the thumbnail cache, from the URL and
+        the thumbnail settings
+        """
+        if thumbnail_type == 'ts':
+            return ThumbnailCache.key('ts', url, TS_THUMBNAIL_POINTS)
+        projection = getattr(self.projection, 'proj4_init', self.projection)
+        if thumbnail_type == 'grid':
+            return ThumbnailCache.key('grid', url, self.wms_zoom_level, self.add_coastlines, projection,
+                                      self.thumbnail_extent, GRID_THUMBNAIL_SIZE)
+        return ThumbnailCache.key('wms', url, self.wms_layer, self.wms_style, self.wms_zoom_level,
+                                  self.add_coastlines, projection, self.thumbnail_extent,
+                                  self.direct_getmap)
+
+    def cached_thumbnail(self, url, thumbnail_type='wms'):
+        """ Thumbnail from the thumbnail cache, None if not cached """
+        if self.thumbnail_cache is None:
+            return None
+        return self.thumbnail_cache.get(self.thumbnail_key(url, thumbnail_type))
+
     def create_wms_thumbnail(self, url):
         """ Create a base64 encoded thumbnail by means of cartopy.
 
@@ -1357,17 +2776,10 @@ class IndexMMD:
 
         wms_layer = self.wms_layer
         wms_style = self.wms_style
-        wms_zoom_level = self.wms_zoom_level
         wms_timeout = self.wms_timeout
         add_coastlines = self.add_coastlines
-        map_projection = self.projection
-        thumbnail_extent = self.thumbnail_extent
-
-        # map projection string to ccrs projection
-        if isinstance(map_projection,str):
-            map_projection = getattr(ccrs,map_projection)()
 
-        wms = WebMapService(url,timeout=wms_timeout)
+        wms = self.capabilities_cache.get(url, wms_timeout)
         available_layers = list(wms.contents.keys())
 
         if wms_layer not in available_layers:
@@ -1385,16 +2797,42 @@ class IndexMMD:
         else:
             wms_style = None
 
-        if not thumbnail_extent:
+        bbox = None
+        if not self.thumbnail_extent:
             wms_extent = wms.contents[available_layers[0]].boundingBoxWGS84
-            cartopy_extent = [wms_extent[0], wms_extent[2], wms_extent[1], wms_extent[3]]
+            bbox = [wms_extent[0], wms_extent[2], wms_extent[1], wms_extent[3]]
+        cartopy_extent_zoomed = self.zoomed_extent(bbox)
 
-            cartopy_extent_zoomed = [wms_extent[0] - wms_zoom_level,
-                    wms_extent[2] + wms_zoom_level,
-                    wms_extent[1] - wms_zoom_level,
-                    wms_extent[3] + wms_zoom_level]
+        renderer = self.get_renderer()
+        native_crs = None
+        if self.direct_getmap:
+            native_crs = renderer.find_native_crs(wms.contents[wms_layer].crsOptions)
+        thumbnail_buffer = renderer.render(wms, wms_layer, wms_style, cartopy_extent_zoomed,
+                                           add_coastlines, native_crs, wms_timeout)
+
+        # The buffer is encoded without copying
+        return self.encode_base64(thumbnail_buffer.getbuffer())
+
+    def zoomed_extent(self, bbox):
+        """ Extent of a thumbnail in lat/lon [x0, x1, y0, y1], the thumbnail
+        extent if given, else the bounding box widened by the zoom level,
+        within the limits of lat/lon.
+
+            Args:
+                bbox (list): bounding box of the data [x0, x1, y0, y1],
+                             not used with a thumbnail extent
+            Returns:
+                list: extent
+        """
+        wms_zoom_level = self.wms_zoom_level
+        thumbnail_extent = self.thumbnail_extent
+        if not thumbnail_extent:
+            cartopy_extent_zoomed = [bbox[0] - wms_zoom_level,
+                    bbox[1] + wms_zoom_level,
+                    bbox[2] - wms_zoom_level,
+                    bbox[3] + wms_zoom_level]
         else:
-            cartopy_extent_zoomed = thumbnail_extent
+            cartopy_extent_zoomed = list(thumbnail_extent)
 
         max_extent = [-180.0, 180.0, -90.0, 90.0]
 
@@ -1405,73 +2843,297 @@ class IndexMMD:
             else:
                 if extent > max_extent[i]:
                     cartopy_extent_zoomed[i] = max_extent[i]
+        return cartopy_extent_zoomed
 
-        subplot_kw = dict(projection=map_projection)
-        self.logger.info(subplot_kw)
-
-        fig, ax = plt.subplots(subplot_kw=subplot_kw)
+    def get_renderer(self):
+        """ Thumbnail renderer of the thumbnail projection, the figure of
+        each projection is reused
+        """
+        map_projection = self.projection
+        # map projection string to ccrs projection
+        if isinstance(map_projection,str):
+            map_projection = getattr(ccrs,map_projection)()
 
+        renderer_key = map_projection.proj4_init
+        if renderer_key not in self.renderers:
+            self.renderers[renderer_key] = ThumbnailRenderer(map_projection)
+        return self.renderers[renderer_key]
 
-        # transparent background
-        ax.spines['geo'].set_visible(False)
-        fig.patch.set_alpha(0)
-        fig.set_alpha(0)
-        fig.set_figwidth(4.5)
-        fig.set_figheight(4.5)
-        fig.set_dpi(100)
 
-        try:
-            ax.add_wms(wms, wms_layer,
-                wms_kwargs={'transparent': False,
-                    'styles':wms_style})
-        except Exception as e:
-            self.logger.error('Could not set up WMS plotting: %s', e)
+    def get_base64(self, fpath):
+        """ Method converting a file to a base64 encoded string 
 
-        if add_coastlines:
-            ax.coastlines(resolution="50m",linewidth=0.5)
-        if map_projection == ccrs.PlateCarree():
-            ax.set_extent(cartopy_extent_zoomed)
-        else:
-            ax.set_extent(cartopy_extent_zoomed, ccrs.PlateCarree())
+            Args:
+                fpath (str): absolute filepath to image
 
-        thumbnail_fname = 'thumbnail_{}.png'.format(self.id)
-        fig.savefig(thumbnail_fname, format='png', bbox_inches='tight')
-        plt.close('all')
+            Returns:
+                thumbnail_b64 (str): base64 string in utf-8
+        """
+        with open(fpath, 'rb') as infile:
+            return self.encode_base64(infile.read())
 
-        thumbnail_b64 = self.get_base64(thumbnail_fname)
+    @staticmethod
+    def encode_base64(data):
+        """ Method converting image data to a base64 encoded string
 
-        # Remove thumbnail
-        os.remove(thumbnail_fname)
-        return thumbnail_b64
+            Args:
+                data (bytes-like): image, e.g. bytes or a memoryview of a
+                                   buffer
 
+            Returns:
+                thumbnail_b64 (str): base64 string in utf-8
+        """
+        return 'data:image/png;base64,' + base64.b64encode(data).decode('ascii')
 
-    def get_base64(self, fpath):
-        """ Method converting a file to a base64 encoded string 
+    def create_grid_thumbnail(self, url):
+        """ Create a base64 encoded quicklook of the first time step of the
+        main data variable of a gridded dataset, in the thumbnail
+        projection. The grid is read with strides giving at most
+        GRID_THUMBNAIL_SIZE points in each direction, so the transfer and
+        memory used don't depend on the size of the grid.
 
             Args:
-                fpath (str): absolute filepath to image
+                url (str): OPeNDAP URL, or URL mapped to a local file
+            Returns:
+                thumbnail_b64: base64 string representation of image
+        """
+        ds = self.open_dataset(url)
+        try:
+            datavar, lonvar, latvar = self.find_grid_variables(ds)
+            ydim, xdim = datavar.dimensions[-2:]
+            sy = max(1, -(-ds.dimensions[ydim].size // GRID_THUMBNAIL_SIZE))
+            sx = max(1, -(-ds.dimensions[xdim].size // GRID_THUMBNAIL_SIZE))
+            self.logger.info('Reading %s with strides %d, %d', datavar.name, sy, sx)
+            index = (0,)*(datavar.ndim - 2) + (slice(None, None, sy), slice(None, None, sx))
+            data = numpy.ma.masked_invalid(numpy.ma.asarray(datavar[index], dtype=float))
+            if latvar.ndim == 1:
+                lat = numpy.asarray(latvar[::sy], dtype=float)
+                lon = numpy.asarray(lonvar[::sx], dtype=float)
+            else:
+                lat = numpy.asarray(latvar[::sy, ::sx], dtype=float)
+                lon = numpy.asarray(lonvar[::sy, ::sx], dtype=float)
+        finally:
+            ds.close()
+        if data.count() == 0:
+            raise Exception('No valid values of %s' % datavar.name)
+        lon = numpy.where(lon > 180, lon - 360, lon)
+        if lon.ndim == 1:
+            order = numpy.argsort(lon)
+            lon = lon[order]
+            data = data[:, order]
+
+        extent = self.zoomed_extent([numpy.nanmin(lon), numpy.nanmax(lon),
+                                     numpy.nanmin(lat), numpy.nanmax(lat)])
+        thumbnail_buffer = self.get_renderer().render_grid(lon, lat, data, extent, self.add_coastlines)
+        return self.encode_base64(thumbnail_buffer.getbuffer())
+
+    @staticmethod
+    def find_grid_variables(ds):
+        """ Find the main data variable of a gridded dataset and its
+        longitude and latitude, either 1D along the last two dimensions of
+        the variable or 2D over them.
 
+            Args:
+                ds (netCDF4.Dataset): dataset
             Returns:
-                thumbnail_b64 (str): base64 string in utf-8
+                tuple: (data, longitude, latitude) variables
         """
-        with open(fpath, 'rb') as infile:
-            data = infile.read()
-            encode_string = base64.b64encode(data)
-            del data
+        def attr(var, name):
+            return str(getattr(var, name, '')).lower()
+
+        lats = [var for var in ds.variables.values()
+                if attr(var, 'standard_name') == 'latitude' or
+                attr(var, 'units') in ('degrees_north', 'degree_north', 'degrees_n', 'degree_n')]
+        lons = [var for var in ds.variables.values()
+                if attr(var, 'standard_name') == 'longitude' or
+                attr(var, 'units') in ('degrees_east', 'degree_east', 'degrees_e', 'degree_e')]
+
+        # Coordinates, bounds and quality flags are not data
+        notdata = set(ds.dimensions) | set(var.name for var in lats + lons)
+        for var in ds.variables.values():
+            for name in ('coordinates', 'bounds', 'ancillary_variables'):
+                notdata.update(str(getattr(var, name, '')).split())
+        candidates = []
+        for var in ds.variables.values():
+            if (var.ndim < 2 or var.name in notdata or var.dtype.kind not in 'fiu' or
+                    'flag_values' in var.ncattrs() or 'flag_meanings' in var.ncattrs()):
+                continue
+            spatial = var.dimensions[-2:]
+            lat = [lat for lat in lats if lat.dimensions in (spatial, spatial[:1])]
+            lon = [lon for lon in lons if lon.dimensions in (spatial, spatial[1:])]
+            if lat and lon and lat[0].ndim == lon[0].ndim:
+                candidates.append((var, lon[0], lat[0]))
+        if not candidates:
+            raise Exception('No gridded data variable found')
+        # Variables with a standard name are preferred
+        candidates.sort(key=lambda candidate: 'standard_name' not in candidate[0].ncattrs())
+        return candidates[0]
+
+    def create_ts_thumbnail(self, url):
+        """ Create a base64 encoded sparkline of the main data variable of
+        a timeSeries, trajectory or profile dataset. The variable is read
+        with a stride giving at most TS_THUMBNAIL_POINTS values, so the
+        transfer and memory used don't depend on the length of the
+        series. For datasets with several stations or trajectories the
+        first one is shown, also when they are stored as ragged arrays.
 
-        
-        thumbnail_b64 = (b'data:image/png;base64,' +
-                encode_string).decode('utf-8')
-        
-        del encode_string
+            Args:
+                url (str): OPeNDAP URL, or URL mapped to a local file
+            Returns:
+                thumbnail_b64: base64 string representation of image
+        """
+        ds = self.open_dataset(url)
+        try:
+            featureType = str(getattr(ds, 'featureType', '')).lower()
+            axisvar, datavar = self.find_ts_variables(ds, featureType == 'profile')
+            dim = axisvar.dimensions[-1]
+            samples, selected = self.find_ts_samples(ds, dim)
+            self.logger.info('Reading %s and %s at %s', axisvar.name, datavar.name, samples)
+            values = []
+            for var in (axisvar, datavar):
+                index = tuple(samples if vardim == dim else 0 for vardim in var.dimensions)
+                value = numpy.ma.asarray(var[index], dtype=float)
+                if selected is not None:
+                    value = value[selected]
+                values.append(numpy.ma.masked_invalid(value))
+            label = getattr(datavar, 'long_name', getattr(datavar, 'standard_name', datavar.name))
+            if hasattr(datavar, 'units'):
+                label = '%s (%s)' % (label, datavar.units)
+            positive = str(getattr(axisvar, 'positive', '')).lower()
+        finally:
+            ds.close()
+        x, y = values
+        if y.count() == 0:
+            raise Exception('No valid values of %s' % datavar.name)
+
+        # Profiles are drawn along the vertical axis
+        if featureType == 'profile':
+            fig = Figure(figsize=(2.0, 4.5), dpi=100)
+            ax = fig.add_subplot()
+            ax.plot(y, x, linewidth=1)
+            if positive == 'down':
+                ax.invert_yaxis()
+        else:
+            fig = Figure(figsize=(4.5, 1.5), dpi=100)
+            ax = fig.add_subplot()
+            ax.plot(x, y, linewidth=1)
+        ax.set_axis_off()
+        ax.set_title(label, fontsize=8)
+        thumbnail_buffer = io.BytesIO()
+        fig.savefig(thumbnail_buffer, format='png', transparent=True, bbox_inches='tight')
+        return self.encode_base64(thumbnail_buffer.getbuffer())
+
+    @staticmethod
+    def find_ts_variables(ds, vertical=False):
+        """ Find the coordinate along the samples and the main data variable
+        of a discrete sampling geometry dataset.
 
-        return thumbnail_b64
+            Args:
+                ds (netCDF4.Dataset): dataset
+                vertical (bool): if the samples are along the vertical
+                                 axis, as in profiles, else along time
+            Returns:
+                tuple: (coordinate, data) variables
+        """
+        def attr(var, name):
+            return str(getattr(var, name, '')).lower()
+
+        def is_time(var):
+            return attr(var, 'standard_name') == 'time' or attr(var, 'axis') == 't' or var.name == 'time'
+
+        def is_vertical(var):
+            return (attr(var, 'axis') == 'z' or 'positive' in var.ncattrs() or
+                    attr(var, 'standard_name') in ('depth', 'altitude', 'height', 'air_pressure',
+                                                   'sea_water_pressure'))
+
+        is_axis = is_vertical if vertical else is_time
+        axisvars = [var for var in ds.variables.values() if is_axis(var) and var.dimensions]
+        if not axisvars:
+            raise Exception('No %s coordinate found' % ('vertical' if vertical else 'time'))
+        axisvar = axisvars[0]
+        dim = axisvar.dimensions[-1]
+
+        # Coordinates, bounds and quality flags are not data
+        notdata = set(ds.dimensions)
+        for var in ds.variables.values():
+            for name in ('coordinates', 'bounds', 'ancillary_variables'):
+                notdata.update(str(getattr(var, name, '')).split())
+        candidates = [var for var in ds.variables.values()
+                      if dim in var.dimensions and var.name not in notdata
+                      and var.dtype.kind in 'fiu'
+                      and not is_time(var) and not is_vertical(var)
+                      and attr(var, 'standard_name') not in ('latitude', 'longitude')
+                      and 'flag_values' not in var.ncattrs() and 'flag_meanings' not in var.ncattrs()
+                      and 'cf_role' not in var.ncattrs()
+                      and 'sample_dimension' not in var.ncattrs()
+                      and 'instance_dimension' not in var.ncattrs()]
+        if not candidates:
+            raise Exception('No data variable along %s found' % dim)
+        # Variables with a standard name are preferred
+        candidates.sort(key=lambda var: 'standard_name' not in var.ncattrs())
+        return axisvar, candidates[0]
+
+    @staticmethod
+    def find_ts_samples(ds, dim):
+        """ Find the samples of the first instance (station, trajectory or
+        profile) along the sample dimension, at most TS_THUMBNAIL_POINTS of
+        them. In contiguous ragged arrays the count variable (attribute
+        sample_dimension) gives the number of samples of each instance, in
+        indexed ragged arrays the index variable (attribute
+        instance_dimension) gives the instance of each sample. Otherwise all
+        samples along dim belong to each instance. At most
+        TS_THUMBNAIL_INDEX_POINTS values of the index variable, and of each
+        variable drawn, are read.
 
-    def create_ts_thumbnail(self):
-        """ Create a base64 encoded thumbnail """
+            Args:
+                ds (netCDF4.Dataset): dataset
+                dim (str): sample dimension
+            Returns:
+                tuple: (samples, selected) where samples is the slice read
+                       along dim and selected the indices of the samples of
+                       the first instance in what is read, None if all
+        """
+        start, stop = 0, ds.dimensions[dim].size
+        positions = None
+        for var in ds.variables.values():
+            if getattr(var, 'sample_dimension', None) == dim:
+                # The first instance has the first samples
+                stop = min(stop, int(numpy.ma.filled(var[0], 0)))
+                break
+            if var.dimensions == (dim,) and 'instance_dimension' in var.ncattrs():
+                # The index is read with a stride not sharing a factor with
+                # the number of instances, so samples of interleaved
+                # instances are all met
+                stride = max(1, -(-stop // TS_THUMBNAIL_INDEX_POINTS))
+                instancedim = ds.dimensions.get(str(var.instance_dimension))
+                noinstances = instancedim.size if instancedim is not None else 1
+                if stride > 1:
+                    while math.gcd(stride, noinstances) != 1:
+                        stride += 1
+                positions = stride*numpy.flatnonzero(numpy.ma.filled(var[::stride], -1) == 0)
+                break
+        if positions is None:
+            stride = max(1, -(-(stop - start) // TS_THUMBNAIL_POINTS))
+            return slice(start, stop, stride), None
+
+        positions = positions[::max(1, -(-positions.size // TS_THUMBNAIL_POINTS))]
+        if positions.size == 0:
+            return slice(0, 0), None
+        steps = numpy.diff(positions)
+        if steps.size == 0 or (steps == steps[0]).all():
+            # Evenly spaced samples are read as one hyperslab
+            return slice(int(positions[0]), int(positions[-1]) + 1, int(steps[0]) if steps.size else 1), None
+        # Reading single samples would take a request each, the samples
+        # spanned are read with the stride of the index variable, they are
+        # no more than the index values read
+        return (slice(int(positions[0]), int(positions[-1]) + 1, stride),
+                (positions - positions[0]) // stride)
 
     def get_feature_type(self, myopendap):
-        """ Set feature type from OPeNDAP """
+        """ Set feature type from OPeNDAP. The feature type is '' if the
+        dataset has no featureType and None if it is not valid, and is
+        stored in the feature type cache if there is one.
+        """
         self.logger.info("Now in get_feature_type")
 
         if len(myopendap) > 1:
@@ -1479,27 +3141,27 @@ class IndexMMD:
         else:
             tmpstr = myopendap[0]
             myopendap = tmpstr
-        # Open as OPeNDAP
-        try:
-            ds = netCDF4.Dataset(myopendap, 'r')
-        except Exception as e:
-            self.logger.error("Something failed reading dataset: %s", str(e))
-            raise
-
-        # Try to get the global attribute featureType
         try:
-            featureType = ds.getncattr('featureType')
+            if self.local_path(myopendap) is not None:
+                featureType = self.get_netcdf_feature_type(myopendap)
+            else:
+                featureType = self.get_das_feature_type(myopendap)
         except Exception as e:
-            self.logger.error("Something failed extracting featureType: %s", str(e))
-            raise
-        ds.close()
+            if is_host_failure(e):
+                self.logger.error("Something failed reading dataset: %s", str(e))
+                raise
+            self.logger.info("Could not read DAS, opening dataset instead: %s", str(e))
+            featureType = self.get_netcdf_feature_type(myopendap)
 
         #create dict lower:valid to map current lower value to valid.
         validfeaturetypes = {'point' : 'point', 'timeseries' : 'timeSeries',
                              'trajectory' : 'trajectory', 'profile' : 'profile',
                              'timeseriesprofile' : 'timeSeriesProfile', 'trajectoryprofile' : 'trajectoryProfile'}
 
-        if featureType not in validfeaturetypes.values():
+        if featureType is None:
+            self.logger.info("No featureType in %s", myopendap)
+            featureType = ''
+        elif featureType not in validfeaturetypes.values():
             self.logger.warning("The featureType found - %s - is not valid", featureType)
             self.logger.warning("Fixing this locally")
             if featureType.lower() in validfeaturetypes.keys():
@@ -1508,9 +3170,87 @@ class IndexMMD:
                 print("The featureType cannot be mapped to any valid value")
                 featureType = None
 
+        if self.feature_type_cache is not None:
+            self.feature_type_cache.put(myopendap, featureType)
         return featureType
             #raise
 
+    def get_das_feature_type(self, myopendap):
+        """ Read the global attribute featureType from the DAS of an OPeNDAP
+        dataset, without fetching the DDS and building the dataset model.
+
+            Args:
+                myopendap (str): OPeNDAP URL
+            Returns:
+                str: featureType, None if the dataset has none
+        """
+        res = self.opendap_session.get(myopendap+'.das', timeout=self.opendap_timeout)
+        res.raise_for_status()
+        return das_global_attribute(res.text, 'featureType')
+
+    def local_path(self, myopendap):
+        """ Find the local file of an OPeNDAP URL from the local directories
+        of URL prefixes.
+
+            Args:
+                myopendap (str): OPeNDAP URL
+            Returns:
+                str: path of the file, None if not mapped or not found
+        """
+        for prefix in self.local_prefixes:
+            if not myopendap.startswith(prefix):
+                continue
+            directory = os.path.abspath(self.local_paths[prefix])
+            relpath = urllib.parse.unquote(urllib.parse.urlsplit(myopendap[len(prefix):]).path)
+            path = os.path.normpath(os.path.join(directory, relpath.lstrip('/')))
+            # Paths leaving the directory are not followed
+            if path.startswith(directory + os.sep) and os.path.isfile(path):
+                return path
+        return None
+
+    def open_dataset(self, myopendap):
+        """ Open a dataset with netCDF4, from the local file if the URL maps
+        to one, else over OPeNDAP.
+
+            Args:
+                myopendap (str): OPeNDAP URL
+            Returns:
+                netCDF4.Dataset: dataset opened for reading
+        """
+        path = self.local_path(myopendap)
+        if path is not None:
+            self.logger.info('Reading %s from %s', myopendap, path)
+            return netCDF4.Dataset(path, 'r')
+        # Small variables are not fetched before they are read
+        return netCDF4.Dataset(myopendap + ('&' if '#' in myopendap else '#') + 'noprefetch', 'r')
+
+    def get_netcdf_feature_type(self, myopendap):
+        """ Read the global attribute featureType of a dataset with netCDF4
+
+            Args:
+                myopendap (str): OPeNDAP URL
+            Returns:
+                str: featureType, None if the dataset has none
+        """
+        # Open as OPeNDAP, or the local file
+        try:
+            ds = self.open_dataset(myopendap)
+        except Exception as e:
+            self.logger.error("Something failed reading dataset: %s", str(e))
+            raise
+
+        # Try to get the global attribute featureType
+        try:
+            featureType = ds.getncattr('featureType')
+        except AttributeError:
+            featureType = None
+        except Exception as e:
+            self.logger.error("Something failed extracting featureType: %s", str(e))
+            raise
+        finally:
+            ds.close()
+        return featureType
+
     # FIXME check if can be deleted, Øystein Godøy, METNO/FOU, 2023-03-21
     # Not sure if this is needed onwards, but keeping for now.
     def search(self):
@@ -1527,35 +3267,510 @@ class IndexMMD:
     and have been marked as parent
     """
     def find_parent_in_index(self, id):
-        url = str(self.solrc)+'/get?id='+id
-        res = requests.get(str(self.mysolrserver)+'/get?id='+id, auth=self.authentication)
+        res = self.session.get(str(self.mysolrserver)+'/get', params={'id': id},
+                               auth=self.authentication)
         res.raise_for_status()
         return res.json()
 
+    def find_parents_in_index(self, ids, fields=None, max_url_length=MAX_GET_IDS_LENGTH):
+        """ Use SolR real-time get to look up many documents at once. The
+        ids are sent in chunks to keep the URL within limits of servers
+        and proxies.
+
+        Args:
+            ids (iterable): SolR ids to look up
+            fields (str): comma separated fields to return, all if None
+            max_url_length (int): maximum length of the ids parameter
+        Returns:
+            dict: SolR documents found in the index by id
+        """
+        found = dict()
+        chunk = []
+        length = 0
+        ids = list(ids)
+        for i, id in enumerate(ids):
+            chunk.append(id)
+            length += len(id)+1
+            if i+1 < len(ids) and length+len(ids[i+1]) < max_url_length:
+                continue
+            params = {'ids': ','.join(chunk)}
+            if fields is not None:
+                params['fl'] = fields
+            res = self.session.get(str(self.mysolrserver)+'/get', params=params,
+                                   auth=self.authentication)
+            res.raise_for_status()
+            for doc in res.json()['response']['docs']:
+                found[doc['id']] = doc
+            chunk = []
+            length = 0
+        self.logger.info('Found %d of %d documents in the index', len(found), len(ids))
+        return found
+
+    def update_parents(self, ids):
+        """ Flag documents already in the index as parents using atomic
+        updates, only the isParent field is sent. Atomic updates of
+        documents not in the index would create them, thus the ids are
+        looked up first.
+
+        Args:
+            ids (iterable): SolR ids of the parents
+        Returns:
+            set: ids of parents not found in the index
+        """
+        ids = set(ids)
+        parents = self.find_parents_in_index(ids, fields='id,isParent')
+        updates = [{'id': id, 'isParent': 'true'} for id, parent in parents.items()
+                   if parent.get('isParent') not in (True, 'true')]
+        if len(updates) > 0:
+            self.logger.info('Flagging %d documents in the index as parent', len(updates))
+            self.parent_updater.submit(updates)
+            self.parent_updater.flush()
+            self.parent_updater.log_stats()
+        return ids - set(parents)
+
+    def keep_parents(self, records):
+        """ Keep the parent flag of documents flagged as parents in the
+        index. When only changed files are indexed, a parent may be indexed
+        again without any of its children, which would clear the flag.
+
+        Args:
+            records (list): SolR documents, updated in place
+        """
+        ids = [rec['id'] for rec in records if rec.get('isParent') != 'true']
+        if len(ids) == 0:
+            return
+        parents = self.find_parents_in_index(ids, fields='id,isParent')
+        for rec in records:
+            if parents.get(rec['id'], dict()).get('isParent') in (True, 'true'):
+                set_parent(rec)
+
+class IndexManifest:
+    """ Manifest of MMD files indexed in a SolR core, kept in a SQLite
+    database. Used to skip files that have not changed since they were
+    last indexed.
     """
-    Update the parent document we got from solr.
-    some fields need to be removed for solr to accept the update.
+
+    def __init__(self, dbfile, solrcore):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.IndexManifest')
+        self.logger.info('Using manifest: %s', dbfile)
+        self.solrcore = solrcore
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS indexed_files (
+            solrcore TEXT NOT NULL,
+            path TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            id TEXT NOT NULL,
+            indexed TEXT NOT NULL,
+            PRIMARY KEY (solrcore, path))''')
+        self.db.commit()
+        # Files changed, by path, and converted files waiting to be
+        # indexed, by SolR id and path. Several files may have the same
+        # SolR id, they are all recorded when the id is indexed.
+        self.changed = dict()
+        self.pending = dict()
+        self.noskipped = 0
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def checksum(myfile):
+        """ SHA-256 checksum of a file """
+        myhash = hashlib.sha256()
+        with open(myfile, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b''):
+                myhash.update(chunk)
+        return myhash.hexdigest()
+
+    def select_changed(self, myfiles):
+        """ Generator skipping files that are unchanged since they were
+            indexed. Files with the same modification time and size are
+            not read, otherwise the checksum decides. Files that can't be
+            examined are passed on to be reported by the conversion.
+
+            Args:
+                myfiles (iterable): paths to MMD files
+            Yields:
+                str: path to MMD file that is new or changed
+        """
+        for myfile in myfiles:
+            path = os.path.abspath(myfile)
+            try:
+                mystat = os.stat(path)
+                row = self.db.execute('SELECT mtime_ns, size, sha256 FROM indexed_files WHERE solrcore=? AND path=?',
+                                      (self.solrcore, path)).fetchone()
+                if row is not None and row[0] == mystat.st_mtime_ns and row[1] == mystat.st_size:
+                    self.noskipped += 1
+                    continue
+                mysha = self.checksum(path)
+            except OSError as e:
+                self.logger.warning('Could not examine %s: %s', myfile, e)
+                yield myfile
+                continue
+            if row is not None and row[2] == mysha:
+                # Touched, but not changed
+                self.db.execute('UPDATE indexed_files SET mtime_ns=?, size=? WHERE solrcore=? AND path=?',
+                                (mystat.st_mtime_ns, mystat.st_size, self.solrcore, path))
+                self.noskipped += 1
+                continue
+            self.changed[myfile] = (path, mystat.st_mtime_ns, mystat.st_size, mysha)
+            yield myfile
+        self.db.commit()
+
+    def converted(self, myfile, myid):
+        """ Remember the SolR id of a converted file until it is indexed """
+        if myfile in self.changed:
+            path, mtime_ns, size, mysha = self.changed.pop(myfile)
+            self.pending.setdefault(myid, dict())[path] = (mtime_ns, size, mysha)
+
+    def indexed(self, ids):
+        """ Record files with the SolR ids given as indexed
+
+            Args:
+                ids (iterable): SolR ids of the documents indexed
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        rows = []
+        for myid in ids:
+            for path, (mtime_ns, size, mysha) in self.pending.pop(myid, dict()).items():
+                rows.append((self.solrcore, path, mtime_ns, size, mysha, myid, now))
+        self.db.executemany('INSERT OR REPLACE INTO indexed_files VALUES (?,?,?,?,?,?,?)', rows)
+        self.db.commit()
+
+    def failed(self, ids):
+        """ Forget files with the SolR ids given, they are tried again
+            next time.
+        """
+        for myid in ids:
+            self.pending.pop(myid, None)
+
+def init_task_worker(logqueue, initializer=None, initargs=()):
+    """ Set up logging in a task worker """
+    init_worker_logging(logqueue)
+    if initializer is not None:
+        initializer(*initargs)
+
+# Instance of IndexMMD without SolR client in task worker processes
+worker_indexer = None
+
+def init_indexer_worker(worker_args):
+    """ Create the IndexMMD instance of a task worker
+
+        Args:
+            worker_args (dict): keyword arguments of IndexMMD
+    """
+    global worker_indexer
+    worker_indexer = IndexMMD(None, **worker_args)
+
+def create_thumbnail_task(task):
+    """ Create a thumbnail in a task worker process
+
+        Args:
+            task (tuple): (url, thumbnail_type, settings) where settings
+                          are the thumbnail attributes of IndexMMD
+        Returns:
+            tuple: (thumbnail, host_failed) where thumbnail is the base64
+                   string representation of image, None on failure
+    """
+    url, thumbnail_type, settings = task
+    for key, value in settings.items():
+        setattr(worker_indexer, key, value)
+    thumbnail = worker_indexer.add_thumbnail(url=url, thumbnail_type=thumbnail_type)
+    return (thumbnail, is_host_failure(worker_indexer.remote_error))
+
+def feature_type_task(url):
+    """ Read the feature type of an OPeNDAP dataset in a task worker process
+
+        Args:
+            url (str): OPeNDAP URL
+        Returns:
+            tuple: (featureType, host_failed) where featureType is '' if
+                   the dataset has none and None on failure
+    """
+    try:
+        return (worker_indexer.get_feature_type([url]), False)
+    except Exception as e:
+        worker_indexer.logger.warning("Something failed while retrieving feature type: %s", str(e))
+        return (None, is_host_failure(e))
+
+def convert_mmd_file(myfile):
+    """ Parse, check and convert one MMD file to the SolR representation.
+        This is run in the worker processes when --workers is used, thus
+        failures are returned rather than logged.
+
+        Args:
+            myfile (str): path to MMD file
+        Returns:
+            tuple: (myfile, newdoc, failure) where failure is None on
+                   success and otherwise a (stage, message) tuple with
+                   stage being 'read', 'check' or 'convert'
     """
-    def solr_updateparent(self, parent):
-        if 'full_text' in parent:
-            parent.pop('full_text')
-        if 'bbox__maxX' in parent:
-            parent.pop('bbox__maxX')
-        if 'bbox__maxY' in parent:
-            parent.pop('bbox__maxY')
-        if 'bbox__minX' in parent:
-            parent.pop('bbox__minX')
-        if 'bbox__minY' in parent:
-            parent.pop('bbox__minY')
-        if 'bbox_rpt' in parent:
-            parent.pop('bbox_rpt')
-        if 'ss_access' in parent:
-            parent.pop('ss_access')
-        if '_version_' in parent:
-            parent.pop('_version_')
-
-        parent['isParent'] = True
-        return parent
+    try:
+        mydoc = MMD4SolR(myfile)
+    except Exception as e:
+        return (myfile, None, ('read', str(e)))
+    try:
+        mydoc.check_mmd()
+    except Exception as e:
+        return (myfile, None, ('check', str(e)))
+    try:
+        newdoc = mydoc.tosolr()
+    except Exception as e:
+        return (myfile, None, ('convert', str(e)))
+
+    return (myfile, newdoc, None)
+
+def imap_bounded(pool, func, iterable, max_inflight):
+    """ Like Pool.imap, but never more than max_inflight tasks are
+        submitted ahead of the consumer. Pool.imap reads the whole input
+        and buffers all results that are not yet consumed.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_inflight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def init_worker_logging(logqueue):
+    """ Route logging in worker processes through the queue to the parent """
+    mylog = logging.getLogger('indexdata')
+    for handler in list(mylog.handlers):
+        mylog.removeHandler(handler)
+    mylog.addHandler(QueueHandler(logqueue))
+    mylog.setLevel(logging.INFO)
+
+def convert_mmd_files(myfiles, workers=1, max_inflight=None):
+    """ Generator parsing, checking and converting MMD files. Files that
+        fail are reported and skipped. With more than one worker the
+        files are processed in a pool of processes, results are still
+        returned in input order.
+
+        Args:
+            myfiles (iterable): paths to MMD files, consumed lazily
+            workers (int): number of worker processes
+            max_inflight (int): maximum number of files submitted to the
+                                workers but not yet returned
+        Yields:
+            tuple: (myfile, newdoc) for each file converted
+    """
+    mylog = logging.getLogger('indexdata')
+    if workers > 1:
+        mylog.info('Converting MMD files using %d worker processes', workers)
+        logqueue = multiprocessing.Queue()
+        listener = QueueListener(logqueue, *mylog.handlers, respect_handler_level=True)
+        listener.start()
+        pool = multiprocessing.Pool(workers, initializer=init_worker_logging, initargs=(logqueue,))
+        results = imap_bounded(pool, convert_mmd_file, myfiles, max_inflight or 4*workers)
+    else:
+        results = map(convert_mmd_file, myfiles)
+
+    completed = False
+    try:
+        fileno = 0
+        for myfile, newdoc, failure in results:
+            fileno += 1
+            mylog.info('\n\tProcessed file: %d - %s',fileno, myfile)
+            if failure is None:
+                yield (myfile, newdoc)
+                continue
+            stage, message = failure
+            if stage == 'read':
+                mylog.error('Could not handle file: %s %s', myfile, message)
+            elif stage == 'check':
+                mylog.error('File: %s is not compliant with MMD specification, skipping this', myfile)
+                mylog.error(message)
+            else:
+                mylog.warning('Could not process the file: %s', myfile)
+                mylog.warning('Message returned: %s', message)
+        completed = True
+    finally:
+        if workers > 1:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+            listener.stop()
+
+def select_mmd_files(myfiles, directory=None):
+    """ Generator returning the MMD files to operate on
+
+        Args:
+            myfiles (iterable): filenames, e.g. lines of a list file
+            directory (str): directory the filenames are relative to
+        Yields:
+            str: path to MMD file
+    """
+    for myfile in myfiles:
+        myfile = myfile.strip()
+        if not myfile.endswith('.xml'):
+            continue
+        if directory:
+            myfile = os.path.join(directory, myfile)
+        yield myfile
+
+def set_parent_child_relation(newdoc):
+    """ Set isChild and dataset_type of a SolR document. Make some
+        corrections based on experience for harvested records...
+
+        Args:
+            newdoc (dict): SolR document, updated in place
+        Returns:
+            str: SolR id of the parent, None if not a child
+        Raises:
+            ValueError: if the parent is referenced by DOI
+    """
+    if 'related_dataset' not in newdoc:
+        newdoc.update({"isParent": "false"})
+        newdoc.update({"dataset_type": "Level-1"})
+        return None
+
+    # Special fix for NPI FIXME check if still necessary
+    newdoc['related_dataset'] = newdoc['related_dataset'].replace('https://data.npolar.no/dataset/','')
+    newdoc['related_dataset'] = newdoc['related_dataset'].replace('http://data.npolar.no/dataset/','')
+    newdoc['related_dataset'] = newdoc['related_dataset'].replace('http://api.npolar.no/dataset/','')
+    newdoc['related_dataset'] = newdoc['related_dataset'].replace('.xml','')
+    # Skip if DOI is used to refer to parent, that isn't consistent.
+    if 'doi.org' in newdoc['related_dataset']:
+        raise ValueError('Parent is referenced by DOI')
+    # Fix special characters that SolR doesn't like
+    idrepls = [':','/','.']
+    myparentid = newdoc['related_dataset']
+    for e in idrepls:
+        myparentid = myparentid.replace(e,'-')
+    # If related_dataset is present, set this dataset as a child using isChild and dataset_type
+    newdoc.update({"isChild": "true"})
+    newdoc.update({"dataset_type": "Level-2"})
+
+    return myparentid
+
+def set_parent(rec):
+    """ Flag a SolR document as parent """
+    # Not sure if this is needed onwards, but discussion on how isParent works is needed Øystein Godøy, METNO/FOU, 2023-03-31
+    if 'isParent' in rec:
+        if rec['isParent'] ==  'true':
+            if rec['dataset_type'] != 'Level-1':
+                rec.update({'dataset_type': 'Level-1'})
+        else:
+            rec.update({'isParent': 'true'})
+    else:
+        rec.update({'isParent': 'true'})
+        rec.update({'dataset_type': 'Level-1'})
+
+class ParentChildReconciler:
+    """ Resolve parent/child relations of records streamed through
+    indexing. Records waiting to be indexed are kept in an index by SolR
+    id, so a parent is flagged in place when a child referring to it
+    arrives, and a parent arriving after its children is flagged as it
+    is added. Parents that were indexed before their first child was
+    seen, or that are not part of the run, are flagged in the index by
+    reconcile when all records are indexed.
+    """
+
+    def __init__(self):
+        # Set up logging
+        self.logger = logging.getLogger('indexdata.ParentChildReconciler')
+        # Records waiting to be indexed by id
+        self.pending = dict()
+        # Ids referenced as parent, and ids handed over for indexing
+        self.parentids = set()
+        self.indexed = set()
+        # Parents indexed before their first child was seen
+        self.late_parents = set()
+        # Records replaced by a later record with the same id
+        self.noduplicates = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, newdoc):
+        """ Add a SolR document, setting parent/child relations
+
+            Args:
+                newdoc (dict): SolR document, updated in place
+            Raises:
+                ValueError: if the parent is referenced by DOI
+        """
+        myparentid = set_parent_child_relation(newdoc)
+        if myparentid is not None and myparentid not in self.parentids:
+            self.parentids.add(myparentid)
+            if myparentid in self.pending:
+                set_parent(self.pending[myparentid])
+            elif myparentid in self.indexed:
+                self.late_parents.add(myparentid)
+        myid = newdoc['id']
+        if myid in self.parentids:
+            set_parent(newdoc)
+        if myid in self.pending:
+            self.logger.warning('Record %s occurs more than once, the last one is indexed.', myid)
+            self.noduplicates += 1
+        self.pending[myid] = newdoc
+
+    def take(self):
+        """ Hand over the records waiting to be indexed
+
+            Returns:
+                list: SolR documents
+        """
+        records = list(self.pending.values())
+        self.indexed.update(self.pending)
+        self.pending = dict()
+        return records
+
+    def reconcile(self, mysolr):
+        """ Flag parents that could not be flagged before they were
+            indexed, or that are not part of this run, in the index. All
+            records must be indexed before this is called.
+
+            Args:
+                mysolr (IndexMMD): SolR connection
+            Returns:
+                set: ids of parents not found in the index
+        """
+        missing = self.late_parents | (self.parentids - self.indexed)
+        if len(missing) == 0:
+            return set()
+        self.logger.info('Reconciling %d parents with the index', len(missing))
+        return mysolr.update_parents(missing)
+
+def ingest_batch(mysolr, records, addThumbnail, manifest=None, thumbnail_args=None):
+    """ Index a batch of SolR documents
+
+        Args:
+            mysolr (IndexMMD): SolR connection
+            records (list): SolR documents
+            addThumbnail (bool): If thumbnails should be added
+            manifest (IndexManifest): manifest to record indexed files in
+            thumbnail_args (dict): thumbnail arguments of index_record
+        Returns:
+            int: number of records processed
+    """
+    mylog = logging.getLogger('indexdata')
+
+    def done(records, status):
+        # Called when SolR has responded
+        if manifest is not None:
+            if status:
+                manifest.indexed(rec['id'] for rec in records)
+            else:
+                manifest.failed(rec['id'] for rec in records)
+
+    try:
+        # Unchanged children are not read, parents keep the flag they have
+        if manifest is not None:
+            mysolr.keep_parents(records)
+        mysolr.index_record(records2ingest=records, addThumbnail=addThumbnail, done=done,
+                            **(thumbnail_args or {}))
+    except Exception as e:
+        mylog.warning('Something failed during indexing %s', e)
+        done(records, False)
+
+    return len(records)
 
 def main(argv):
 
@@ -1615,13 +3830,78 @@ def main(argv):
 
     # Set up connection to SolR server
     mySolRc = SolrServer+myCore
+    # Number of concurrent update requests to SolR and retries of failed
+    # requests
+    solr_inflight = cfg.get('solr-update-inflight', 1)
+    solr_retries = cfg.get('solr-update-retries', 3)
+    solr_backoff = cfg.get('solr-update-backoff', 2.0)
+    # Size of update requests in bytes, adapted to the latency of SolR if
+    # a target latency (seconds) is given
+    solr_target_bytes = cfg.get('solr-update-target-bytes', 8*1024*1024)
+    solr_max_bytes = cfg.get('solr-update-max-bytes', 32*1024*1024)
+    solr_target_latency = cfg.get('solr-update-target-latency', None)
+    # Timeout of WMS requests, and of creating a thumbnail in a worker
+    wms_timeout = cfg.get('wms-timeout', 120)
+    thumbnail_timeout = cfg.get('wms-thumbnail-timeout', 2*wms_timeout)
+    # Concurrent calls to each WMS and OPeNDAP host, with limits for
+    # single hosts overriding the default
+    host_concurrency = cfg.get('remote-host-concurrency', 4)
+    host_concurrency_by_host = cfg.get('remote-host-concurrency-by-host', None)
+    for host, limit in [(None, host_concurrency)] + list((host_concurrency_by_host or dict()).items()):
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise Exception('Concurrent requests{} must be at least 1 in config, not {}'.format(
+                '' if host is None else ' to ' + str(host), limit))
+    # Time allowed for each OPeNDAP request and for opening an OPeNDAP
+    # dataset with --feature_workers, and how records with several OPeNDAP
+    # URLs get their feature type
+    opendap_timeout = cfg.get('opendap-timeout', wms_timeout)
+    feature_type_vote = cfg.get('feature-type-vote', 'first')
+    # Feature types are reused across runs if a cache file is configured
+    feature_type_cache = cfg.get('feature-type-cache', None)
+    feature_type_cache_ttl = cfg.get('feature-type-cache-ttl', None)
+    # Datasets of OPeNDAP URLs starting with these prefixes are read from
+    # the local directories
+    local_paths = cfg.get('opendap-local-paths', None)
+    # Gridded OPeNDAP datasets without WMS get a quicklook thumbnail
+    grid_thumbnails = cfg.get('opendap-grid-thumbnails', True)
+    # GetCapabilities documents are cached in memory, and on disk across
+    # runs if a file is configured
+    capabilities_cache = cfg.get('wms-capabilities-cache', None)
+    capabilities_ttl = cfg.get('wms-capabilities-ttl', 86400)
+    # Thumbnails are reused across runs if a cache file is configured
+    thumbnail_cache = cfg.get('wms-thumbnail-cache', None)
+    thumbnail_cache_ttl = cfg.get('wms-thumbnail-cache-ttl', None)
+    # Request WMS images in the thumbnail projection if offered
+    direct_getmap = cfg.get('wms-direct-getmap', True)
+    # Hosts failing this many times in a row are skipped for a while
+    host_failures = cfg.get('remote-host-failures', 3)
+    host_cooldown = cfg.get('remote-host-cooldown', 600)
     try:
-        mysolr = IndexMMD(mySolRc, args.always_commit, authentication, args.no_feature)
+        mysolr = IndexMMD(mySolRc, args.always_commit, authentication, args.no_feature,
+                          max_inflight=solr_inflight, retries=solr_retries, backoff=solr_backoff,
+                          deadletter=args.dead_letter, target_bytes=solr_target_bytes,
+                          max_bytes=solr_max_bytes, target_latency=solr_target_latency,
+                          thumbnail_workers=args.thumbnail_workers, thumbnail_timeout=thumbnail_timeout,
+                          capabilities_cache=capabilities_cache, capabilities_ttl=capabilities_ttl,
+                          thumbnail_cache=thumbnail_cache, thumbnail_cache_ttl=thumbnail_cache_ttl,
+                          direct_getmap=direct_getmap,
+                          host_failures=host_failures, host_cooldown=host_cooldown,
+                          host_concurrency=host_concurrency,
+                          host_concurrency_by_host=host_concurrency_by_host,
+                          feature_workers=args.feature_workers, opendap_timeout=opendap_timeout,
+                          feature_type_vote=feature_type_vote, feature_type_cache=feature_type_cache,
+                          feature_type_cache_ttl=feature_type_cache_ttl, local_paths=local_paths,
+                          grid_thumbnails=grid_thumbnails)
     except Exception as e:
         mylog.error('Something failed in interaction with the SolR server: %s', e)
         sys.exit(1)
+    if args.refresh_feature_types is not None:
+        if mysolr.feature_type_cache is None:
+            mylog.warning('No feature-type-cache configured, nothing to refresh')
+        else:
+            mysolr.feature_type_cache.invalidate(args.refresh_feature_types)
 
-    # Find files to process
+    # Find files to process, these are read lazily to keep memory use flat
     if args.input_file:
         myfiles = [args.input_file]
     elif args.list_file:
@@ -1630,172 +3910,117 @@ def main(argv):
         except IOError as e:
             mylog.error('Could not open file: %s %e', args.list_file, e)
             sys.exit()
-        myfiles = f2.readlines()
-        f2.close()
+        myfiles = f2
     elif args.directory:
         try:
-            myfiles = os.listdir(args.directory)
+            myfiles = (entry.name for entry in os.scandir(args.directory))
         except Exception as e:
             mylog.error("Something went wrong in decoding cmd arguments: %s", e)
             sys.exit(1)
 
-    fileno = 0
-    myfiles_pending = []
-    files2ingest = []
-    pendingfiles2ingest = []
-    parentids = set()
-    for myfile in myfiles:
-        myfile = myfile.strip()
-        # Decide files to operate on
-        if not myfile.endswith('.xml'):
-            continue
-        if args.list_file:
-            myfile = myfile.rstrip()
-        if args.directory:
-            myfile = os.path.join(args.directory, myfile)
-
-        # FIXME, need a better way of handling this, WMS layers should be interpreted automatically, this way we need to know up fron whether WMS makes sense or not and that won't work for harvesting
-        if args.thumbnail_layer:
-            wms_layer = args.thumbnail_layer
-        else:
-            wms_layer = None
-        if args.thumbnail_style:
-            wms_style = args.thumbnail_style
-        else:
-            wms_style =  None
-        if args.thumbnail_zoom_level:
-            wms_zoom_level = args.thumbnail_zoom_level
-        else:
-            wms_zoom_level=0
-        if args.add_coastlines:
-            wms_coastlines = args.add_coastlines
-        else:
-            wms_coastlines=True
-        if args.thumbnail_extent:
-            thumbnail_extent = [int(i) for i in args.thumbnail_extent[0].split(' ')]
-        else:
-            thumbnail_extent = None
-
-        fileno += 1
-        mylog.info('\n\tProcessing file: %d/%d - %s',fileno, len(myfiles), myfile)
-
-        try:
-            mydoc = MMD4SolR(myfile)
-        except Exception as e:
-            mylog.error('Could not handle file: %s %s', myfile, e)
-            continue
-        try:
-            mydoc.check_mmd()
-        except Exception as e:
-            mylog.error('File: %s is not compliant with MMD specification, skipping this', myfile)
-            mylog.error(e)
-            continue
-
-        """
-        Convert to the SolR format needed
-        """
-        try:
-            newdoc = mydoc.tosolr()
-        except Exception as e:
-            mylog.warning('Could not process the file: %s', myfile)
-            mylog.warning('Message returned: %s', e)
-            continue
+    # FIXME, need a better way of handling this, WMS layers should be interpreted automatically, this way we need to know up fron whether WMS makes sense or not and that won't work for harvesting
+    if args.thumbnail_layer:
+        wms_layer = args.thumbnail_layer
+    else:
+        wms_layer = None
+    if args.thumbnail_style:
+        wms_style = args.thumbnail_style
+    else:
+        wms_style =  None
+    if args.thumbnail_zoom_level:
+        wms_zoom_level = args.thumbnail_zoom_level
+    else:
+        wms_zoom_level=0
+    if args.add_coastlines:
+        wms_coastlines = args.add_coastlines
+    else:
+        wms_coastlines=True
+    if args.thumbnail_extent:
+        thumbnail_extent = [int(i) for i in args.thumbnail_extent[0].split(' ')]
+    else:
+        thumbnail_extent = None
+    tflg = not args.no_thumbnail
+    thumbnail_args = {
+        'wms_layer': wms_layer,
+        'wms_style': wms_style,
+        'wms_zoom_level': wms_zoom_level,
+        'add_coastlines': wms_coastlines,
+        'projection': mapprojection,
+        'wms_timeout': wms_timeout,
+        'thumbnail_extent': thumbnail_extent,
+    }
 
-        if (not args.no_thumbnail) and ('data_access_url_ogc_wms' in newdoc):
-            tflg = True
+    """
+    Stream records through conversion, parent/child resolution and
+    indexing. At most batch_size records are kept waiting for indexing
+    and at most max_inflight records are being converted at any time.
+    """
+    mylog.info("Indexing datasets")
+    mmdfiles = select_mmd_files(myfiles, args.directory)
+    manifest = None
+    if args.incremental:
+        # The manifest is kept next to the logfile unless configured
+        if 'manifest' in cfg:
+            manifestfile = cfg['manifest']
         else:
-            tflg = False
-
+            manifestfile = os.path.join(os.path.dirname(cfgstr['logfile']), 'indexdata-manifest.sqlite')
+        manifest = IndexManifest(manifestfile, mySolRc)
+        mmdfiles = manifest.select_changed(mmdfiles)
+    max_inflight = 4*args.workers
+    reconciler = ParentChildReconciler()
+    myrecs = 0
+    noconverted = 0
+    for myfile, newdoc in convert_mmd_files(mmdfiles, args.workers, max_inflight):
         """
         Checking datasets to see if they are children.
         Datasets that are not children are all set to Level-1.
-        Make some corrections based on experience for harvested records...
         """
         mylog.info('Parsing parent/child relations.')
-        if 'related_dataset' in newdoc:
-            # Special fix for NPI FIXME check if still necessary
-            newdoc['related_dataset'] = newdoc['related_dataset'].replace('https://data.npolar.no/dataset/','')
-            newdoc['related_dataset'] = newdoc['related_dataset'].replace('http://data.npolar.no/dataset/','')
-            newdoc['related_dataset'] = newdoc['related_dataset'].replace('http://api.npolar.no/dataset/','')
-            newdoc['related_dataset'] = newdoc['related_dataset'].replace('.xml','')
-            # Skip if DOI is used to refer to parent, that isn't consistent.
-            if 'doi.org' in newdoc['related_dataset']:
-                continue
-            # Fix special characters that SolR doesn't like
-            idrepls = [':','/','.']
-            myparentid = newdoc['related_dataset']
-            for e in idrepls:
-                myparentid = myparentid.replace(e,'-')
-            # If related_dataset is present, set this dataset as a child using isChild and dataset_type
-            newdoc.update({"isChild": "true"})
-            newdoc.update({"dataset_type": "Level-2"})
-            parentids.add(myparentid)
-        else:
-            newdoc.update({"isParent": "false"})
-            newdoc.update({"dataset_type": "Level-1"})
+        try:
+            reconciler.add(newdoc)
+        except ValueError as e:
+            mylog.warning('Skipping %s: %s', myfile, e)
+            continue
+        noconverted += 1
 
         # Update list of files to process
-        files2ingest.append(newdoc)
-
-    # Check if parents are in the existing list
-    for id in parentids:
-        if not any(d['id'] == id for d in files2ingest):
-            # Check if already ingested and update if so
-            # FIXME, need more robustness...
-            mylog.warning('This part of parent/child relations is yet not tested.')
-            continue
-            parent = mysolr.find_parent_in_index(id)
-            parent = mysolr.solr_updateparent(parent)
-            mysolr.solrc.add([parent])
-        else:
-            # Assuming found in the current batch of files, then set to parent... Not sure if this is needed onwards, but discussion on how isParent works is needed Øystein Godøy, METNO/FOU, 2023-03-31
-            i = 0
-            for rec in files2ingest:
-                if rec['id'] == id:
-                    if 'isParent' in rec:
-                        if rec['isParent'] ==  'true':
-                            if rec['dataset_type'] == 'Level-1':
-                                continue
-                            else:
-                                files2ingest[i].update({'dataset_type': 'Level-1'})
-                        else:
-                            files2ingest[i].update({'isParent': 'true'})
-                    else:
-                        files2ingest[i].update({'isParent': 'true'})
-                        files2ingest[i].update({'dataset_type': 'Level-1'})
-                i += 1
+        if manifest is not None:
+            manifest.converted(myfile, newdoc['id'])
+        if len(reconciler) >= args.batch_size:
+            myrecs += ingest_batch(mysolr, reconciler.take(), tflg, manifest, thumbnail_args)
+    if len(reconciler) > 0:
+        myrecs += ingest_batch(mysolr, reconciler.take(), tflg, manifest, thumbnail_args)
+    mysolr.flush()
+    if args.list_file:
+        f2.close()
+    if manifest is not None:
+        mylog.info('Number of files skipped as unchanged: %d', manifest.noskipped)
+        manifest.close()
+
+    # Parents not in this run, or indexed before any of their children
+    # were seen, are flagged in the index
+    try:
+        for id in reconciler.reconcile(mysolr):
+            mylog.warning('Parent %s is not found in the index.', id)
+    except Exception as e:
+        mylog.warning('Could not flag parents in the index: %s', e)
 
-    if len(files2ingest) == 0:
+    if noconverted == 0:
         mylog.info('No files to ingest.')
+        mysolr.close()
         sys.exit()
 
-    # Do the ingestion FIXME
-    # Check if thumbnail specification need to be changed
-    mylog.info("Indexing datasets")
-    """
-    Split list into sublists before indexing (and retrieving WMS thumbnails etc)
-    """
-    mystep = 2500
-    myrecs = 0
-    for i in range(0,len(files2ingest),mystep):
-        mylist = files2ingest[i:i+mystep]
-        myrecs += len(mylist)
-        try:
-            mysolr.index_record(records2ingest=mylist, addThumbnail=tflg)
-        except Exception as e:
-            mylog.warning('Something failed during indexing %s', e)
-        mylog.info('%d records out of %d have been ingested...', myrecs, len(files2ingest))
-        del mylist
-
-    if myrecs != len(files2ingest):
+    # Records with the same id in a batch are indexed once
+    if myrecs != noconverted - reconciler.noduplicates:
         mylog.warning('Inconsistent number of records processed.')
     # Report status
-    mylog.info("Number of files processed were: %d", len(files2ingest))
+    mylog.info("Number of files processed were: %d", noconverted)
 
     # Add a commit to solr at end of run, according to magnarem auto commit is done every 10 minutes
     if args.always_commit:
         mylog.info("Committing the input to SolR. This may take some time.")
         mysolr.commit()
+    mysolr.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Test caching WMS GetCapabilities documents, served by a small HTTP
+    server in a thread.
+"""
+
+import sys
+import os
+import threading
+import http.server
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import indexdata
+
+CAPABILITIES = b'''<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1" xmlns:xlink="http://www.w3.org/1999/xlink">
+<Service><Name>WMS</Name><Title>test</Title></Service>
+<Capability>
+<Request>
+<GetMap><Format>image/png</Format><DCPType><HTTP><Get><OnlineResource xlink:href="http://localhost/wms?"/></Get></HTTP></DCPType></GetMap>
+</Request>
+<Layer><Title>root</Title><SRS>EPSG:4326</SRS>
+<Layer><Name>temperature</Name><Title>temperature</Title>
+<LatLonBoundingBox minx="0" miny="50" maxx="30" maxy="80"/>
+</Layer>
+</Layer>
+</Capability>
+</WMT_MS_Capabilities>'''
+
+MAINTENANCE = b'<html><body>Down for maintenance</body></html>'
+
+class WMSHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.server.document)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(self.server.document)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WMSHandler)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    httpd.document = MAINTENANCE
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/wms'.format(httpd.server_address[1]), httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_invalid_document_not_cached(server, tmp_path):
+    url, httpd = server
+    dbfile = str(tmp_path / 'capabilities.db')
+    cache = indexdata.CapabilitiesCache(dbfile)
+    for n in range(2):
+        with pytest.raises(Exception):
+            cache.get(url)
+    # Each call asked the server again
+    assert len(httpd.requests) == 2
+    cache.close()
+
+    # Once the service is back it is used, also in a later run
+    httpd.document = CAPABILITIES
+    cache = indexdata.CapabilitiesCache(dbfile)
+    assert list(cache.get(url).contents) == ['temperature']
+    assert len(httpd.requests) == 3
+    cache.close()
+    cache = indexdata.CapabilitiesCache(dbfile)
+    assert list(cache.get(url).contents) == ['temperature']
+    assert len(httpd.requests) == 3
+    cache.close()
+
+def test_revalidated_invalid_document_not_kept(server, tmp_path):
+    url, httpd = server
+    dbfile = str(tmp_path / 'capabilities.db')
+    # A document that never parsed, cached before it was checked
+    cache = indexdata.CapabilitiesCache(dbfile, ttl=0)
+    cache.save(url, {'fetched': 0, 'etag': '"v1"', 'last_modified': None,
+                     'document': MAINTENANCE, 'wms': None})
+    with pytest.raises(Exception):
+        cache.get(url)
+    assert cache.load(url) is None
+    cache.close()
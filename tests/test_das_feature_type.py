@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Test reading featureType from the DAS of OPeNDAP datasets, served by
+    a small HTTP server in a thread.
+"""
+
+import sys
+import os
+import time
+import threading
+import http.server
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import indexdata
+
+DAS = {
+    '/dodsC/timeseries.nc.das': '''Attributes {
+    time {
+        String units "seconds since 1970-01-01";
+        String featureType "ignored, not global";
+    }
+    NC_GLOBAL {
+        String Conventions "CF-1.8";
+        String featureType "timeSeries";
+    }
+}
+''',
+    '/dodsC/grid.nc.das': '''Attributes {
+    lat {
+        String units "degrees_north";
+    }
+    NC_GLOBAL {
+        String Conventions "CF-1.8";
+        String title "featureType \\"profile\\" is in the title";
+    }
+}
+''',
+    '/dodsC/escaped.nc.das': '''Attributes {
+    NC_GLOBAL {
+        String summary "Contains { braces }; and \\"quotes\\"";
+        String featureType "trajectory\\"Profile";
+    }
+    DODS_EXTRA {
+        String Unlimited_Dimension "time";
+    }
+}
+''',
+    '/dodsC/unquoted.nc.das': '''Attributes {
+    THREDDS_GLOBAL {
+        String featureType TimeSeries;
+    }
+}
+''',
+    '/dodsC/slow.nc.das': '''Attributes {
+    NC_GLOBAL {
+        String featureType "point";
+    }
+}
+''',
+}
+
+class DASHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/dodsC/slow.nc'):
+            time.sleep(2)
+        if self.path not in DAS:
+            self.send_error(404)
+            return
+        body = DAS[self.path].encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DASHandler)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/dodsC/'.format(httpd.server_address[1]), httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def indexer(monkeypatch):
+    myindexer = indexdata.IndexMMD(None, opendap_timeout=0.5)
+    # Record the datasets opened with netCDF4 instead of opening them
+    myindexer.opened = []
+    def get_netcdf_feature_type(myopendap):
+        myindexer.opened.append(myopendap)
+        return 'profile'
+    monkeypatch.setattr(myindexer, 'get_netcdf_feature_type', get_netcdf_feature_type)
+    return myindexer
+
+def test_das_global_attribute():
+    assert indexdata.das_global_attribute(DAS['/dodsC/timeseries.nc.das'], 'featureType') == 'timeSeries'
+    assert indexdata.das_global_attribute(DAS['/dodsC/grid.nc.das'], 'featureType') is None
+    assert indexdata.das_global_attribute(DAS['/dodsC/escaped.nc.das'], 'featureType') == 'trajectory"Profile'
+    assert indexdata.das_global_attribute(DAS['/dodsC/escaped.nc.das'], 'summary') == 'Contains { braces }; and "quotes"'
+    assert indexdata.das_global_attribute(DAS['/dodsC/unquoted.nc.das'], 'featureType') == 'TimeSeries'
+    with pytest.raises(ValueError):
+        indexdata.das_global_attribute('<html>Not found</html>', 'featureType')
+
+def test_feature_type_present(server, indexer):
+    url, httpd = server
+    assert indexer.get_feature_type([url + 'timeseries.nc']) == 'timeSeries'
+    # Invalid spelling is mapped to the valid feature type
+    assert indexer.get_feature_type([url + 'unquoted.nc']) == 'timeSeries'
+    assert indexer.opened == []
+
+def test_feature_type_absent(server, indexer):
+    url, httpd = server
+    assert indexer.get_feature_type([url + 'grid.nc']) == ''
+    assert indexer.opened == []
+
+def test_feature_type_escaped(server, indexer):
+    url, httpd = server
+    # Not a valid feature type once unescaped
+    assert indexer.get_feature_type([url + 'escaped.nc']) is None
+    assert indexer.opened == []
+
+def test_feature_type_not_found(server, indexer):
+    url, httpd = server
+    # The DAS can't be read, the dataset is opened with netCDF4
+    assert indexer.get_feature_type([url + 'missing.nc']) == 'profile'
+    assert indexer.opened == [url + 'missing.nc']
+    assert '/dodsC/missing.nc.das' in httpd.requests
+
+def test_feature_type_timeout(server, indexer):
+    url, httpd = server
+    # The host failed, the dataset is not opened
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout) as excinfo:
+        indexer.get_feature_type([url + 'slow.nc'])
+    assert time.monotonic() - start < 1.5
+    assert indexdata.is_host_failure(excinfo.value)
+    assert indexer.opened == []
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Test removing feature types from the feature type cache by URL prefix.
+"""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import indexdata
+
+def test_invalidate_prefix(tmp_path):
+    cache = indexdata.FeatureTypeCache(str(tmp_path / 'feature_types.db'))
+    urls = ['https://thredds.met.no/dodsC/Arctic/a.nc', 'https://thredds.met.no/dodsC/arctic/b.nc',
+            'https://thredds.met.no/dodsC/Arctic_x/c.nc', 'https://thredds.met.no/dodsC/Arctic%/d.nc']
+    for url in urls:
+        cache.put(url, 'timeSeries')
+    # Prefixes are case sensitive and LIKE wildcards are not special
+    assert cache.invalidate('https://thredds.met.no/dodsC/Arctic/') == 1
+    assert cache.invalidate('https://thredds.met.no/dodsC/Arctic%') == 1
+    assert cache.get(urls[1]) == (True, 'timeSeries')
+    assert cache.get(urls[2]) == (True, 'timeSeries')
+    assert cache.invalidate('') == 2
+    cache.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Test indexing only changed MMD files (--incremental) into a small
+    SolR stand-in served by an HTTP server in a thread.
+"""
+
+import sys
+import os
+import json
+import shutil
+import threading
+import http.server
+import urllib.parse
+import xml.etree.ElementTree as XET
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import indexdata
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                       'mmd')
+
+class SolrHandler(http.server.BaseHTTPRequestHandler):
+    """ Ping, real-time get of several ids and updates, with atomic set
+    of fields.
+    """
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if '/admin/ping' in url.path:
+            self.send_json({'status': 'OK'})
+        elif url.path.rstrip('/').endswith('/get'):
+            ids = ','.join(query.get('ids', [])).split(',')
+            docs = [self.server.docs[myid] for myid in ids if myid in self.server.docs]
+            self.send_json({'response': {'numFound': len(docs), 'start': 0, 'docs': docs}})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not urllib.parse.urlsplit(self.path).path.rstrip('/').endswith('/update'):
+            self.send_error(404)
+            return
+        if 'json' in self.headers.get('Content-Type', ''):
+            docs = json.loads(body)
+        else:
+            docs = [{field.get('name'): field.text for field in element.findall('field')}
+                    for element in XET.fromstring(body).iter('doc')]
+        for fields in docs:
+            fields = {name: value['set'] if isinstance(value, dict) else value
+                      for name, value in fields.items()}
+            self.server.posted.append(fields)
+            self.server.docs.setdefault(fields['id'], dict()).update(fields)
+        self.send_json({'responseHeader': {'status': 0}})
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def solr():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SolrHandler)
+    httpd.daemon_threads = True
+    httpd.docs = dict()
+    httpd.posted = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/solr/'.format(httpd.server_address[1]), httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def run(monkeypatch, cfgfile, directory):
+    argv = ['-c', cfgfile, '-d', directory, '-nt', '-f', '-inc']
+    monkeypatch.setattr(sys, 'argv', ['indexdata.py'] + argv)
+    try:
+        indexdata.main(argv)
+    except SystemExit:
+        pass
+
+def test_changed_parent_keeps_flag(solr, monkeypatch, tmp_path):
+    url, httpd = solr
+    cfgfile = str(tmp_path / 'cfg.yml')
+    with open(cfgfile, 'w') as fd:
+        fd.write('logfile: {}\nsolrserver: {}\nsolrcore: core\n'
+                 'wms-thumbnail-projection: Mercator\n'.format(tmp_path / 'indexdata.log', url))
+    directory = tmp_path / 'mmd'
+    directory.mkdir()
+    shutil.copy(os.path.join(DATADIR, 'full.xml'), str(directory))
+    shutil.copy(os.path.join(DATADIR, 'child.xml'), str(directory))
+
+    run(monkeypatch, cfgfile, str(directory))
+    assert httpd.docs['no-met-1111-aaaa']['isParent'] == 'true'
+    assert httpd.docs['no-met-2222-bbbb']['isChild'] == 'true'
+
+    # Only the parent changed, the child is skipped
+    with open(str(directory / 'full.xml'), 'a') as fd:
+        fd.write('\n')
+    httpd.posted = []
+    run(monkeypatch, cfgfile, str(directory))
+    assert [fields['id'] for fields in httpd.posted] == ['no-met-1111-aaaa']
+    assert httpd.posted[0]['isParent'] == 'true'
+    assert httpd.posted[0]['dataset_type'] == 'Level-1'
+    assert httpd.docs['no-met-1111-aaaa']['isParent'] == 'true'
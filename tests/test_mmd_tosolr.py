@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Compare the SolR documents created by MMD4SolR with the expected
+    documents for the MMD files in tests/data/mmd.
+
+    The expected documents are stored next to the MMD files as JSON. For
+    files that are rejected, the stage (read, check or convert) where they
+    fail is stored instead of the document. To regenerate the expected
+    documents after an intended change, run:
+
+        python tests/test_mmd_tosolr.py --update
+
+NOTES:
+    Run with pytest or directly, without arguments the differences
+    between the created and expected documents are printed.
+"""
+
+import sys
+import os
+import glob
+import json
+import difflib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import indexdata
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                       'mmd')
+
+def mmd_files():
+    return sorted(glob.glob(os.path.join(DATADIR, '*.xml')))
+
+def convert(myfile):
+    """ Convert one MMD file and return the result as indented JSON, the
+        order of the fields is kept.
+    """
+    myfile, newdoc, failure = indexdata.convert_mmd_file(myfile)
+    if failure is not None:
+        result = {'failure': failure[0]}
+    else:
+        result = {'document': newdoc}
+    return json.dumps(result, indent=2, ensure_ascii=False) + '\n'
+
+def expected_file(myfile):
+    return os.path.splitext(myfile)[0] + '.json'
+
+def diff(myfile):
+    """ Return the unified diff between the expected and created document,
+        empty if they are equal.
+    """
+    with open(expected_file(myfile), encoding='utf-8') as fd:
+        expected = fd.read()
+    created = convert(myfile)
+    return ''.join(difflib.unified_diff(
+        expected.splitlines(True), created.splitlines(True),
+        fromfile=os.path.basename(expected_file(myfile)),
+        tofile=os.path.basename(myfile)))
+
+def test_mmd_tosolr():
+    assert mmd_files()
+    for myfile in mmd_files():
+        differences = diff(myfile)
+        assert not differences, differences
+
+def main():
+    if '--update' in sys.argv[1:]:
+        for myfile in mmd_files():
+            with open(expected_file(myfile), 'w', encoding='utf-8') as fd:
+                fd.write(convert(myfile))
+            print('Updated', expected_file(myfile))
+        return 0
+    failed = 0
+    for myfile in mmd_files():
+        differences = diff(myfile)
+        if differences:
+            failed += 1
+            print(differences)
+    print('{} differences'.format(failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Test finding the samples of the first instance of discrete sampling
+    geometry datasets, drawn in time series thumbnails.
+"""
+
+import sys
+import os
+
+import netCDF4
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import indexdata
+
+def dataset(path, instances, samples):
+    ds = netCDF4.Dataset(str(path / 'ts.nc'), 'w', diskless=True)
+    ds.featureType = 'timeSeries'
+    ds.createDimension('station', instances)
+    ds.createDimension('obs', samples)
+    time = ds.createVariable('time', 'f8', ('obs',))
+    time.standard_name = 'time'
+    time[:] = numpy.arange(samples)
+    temp = ds.createVariable('temp', 'f4', ('obs',))
+    temp.standard_name = 'air_temperature'
+    temp[:] = numpy.arange(samples)
+    return ds
+
+def test_contiguous_ragged_array(tmp_path):
+    ds = dataset(tmp_path, 3, 6000)
+    rowsize = ds.createVariable('row_size', 'i4', ('station',))
+    rowsize.sample_dimension = 'obs'
+    rowsize[:] = [2000, 1000, 3000]
+    assert indexdata.IndexMMD.find_ts_variables(ds)[1].name == 'temp'
+    assert indexdata.IndexMMD.find_ts_samples(ds, 'obs') == (slice(0, 2000, 4), None)
+    ds.close()
+
+def test_indexed_ragged_array(tmp_path):
+    ds = dataset(tmp_path, 4, 4000)
+    index = ds.createVariable('station_index', 'i4', ('obs',))
+    index.instance_dimension = 'station'
+    index[:] = numpy.arange(4000) % 4
+    # The index variable is not data
+    assert indexdata.IndexMMD.find_ts_variables(ds)[1].name == 'temp'
+    assert indexdata.IndexMMD.find_ts_samples(ds, 'obs') == (slice(0, 3993, 8), None)
+
+    # Samples that are not evenly spaced are selected after reading
+    index[:] = numpy.random.default_rng(0).integers(0, 3, 4000)
+    samples, selected = indexdata.IndexMMD.find_ts_samples(ds, 'obs')
+    assert len(selected) <= indexdata.TS_THUMBNAIL_POINTS
+    assert (index[samples][selected] == 0).all()
+    ds.close()
+
+def test_indexed_ragged_array_bounded(tmp_path):
+    # Long series of interleaved stations, the stride of the index
+    # variable must not hit only other stations
+    nosamples = 100*indexdata.TS_THUMBNAIL_INDEX_POINTS
+    for pattern in ([1, 0, 2, 3], list(numpy.random.default_rng(0).integers(0, 4, 1000))):
+        ds = dataset(tmp_path, 4, nosamples)
+        index = ds.createVariable('station_index', 'i4', ('obs',))
+        index.instance_dimension = 'station'
+        index[:] = numpy.resize(pattern, nosamples)
+        samples, selected = indexdata.IndexMMD.find_ts_samples(ds, 'obs')
+        assert len(range(nosamples)[samples]) <= indexdata.TS_THUMBNAIL_INDEX_POINTS
+        values = index[samples] if selected is None else index[samples][selected]
+        assert 0 < len(values) <= indexdata.TS_THUMBNAIL_POINTS
+        assert (values == 0).all()
+        ds.close()
+
+def test_multidimensional_array(tmp_path):
+    ds = dataset(tmp_path, 1, 1000)
+    assert indexdata.IndexMMD.find_ts_samples(ds, 'obs') == (slice(0, 1000, 2), None)
+    ds.close()